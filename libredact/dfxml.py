@@ -31,6 +31,7 @@ where encoding, if present, is 0 for raw, 1 for NTFS compressed.
 from sys import stderr
 from subprocess import Popen,PIPE
 import base64
+import bisect
 import hashlib
 
 import datetime
@@ -117,7 +118,7 @@ def iso8601Tdatetime(s):
 ###  byte_run class
 ###
 
-class byte_run:
+class byte_run(object):
     """The internal representation for a byte run. 
 
     byte_runs have the following attributes:
@@ -128,17 +129,66 @@ class byte_run:
     Originally this was an array,
     which is faster than an attributed object. But this approach is more expandable,
     and it's only 70% the speed of an array under Python3.0.
-    
+
+    Fragmented images have tens of millions of runs, so only the three offsets have slots.
+    Other attributes from new XML (fill, uncompressed_len, sector_size, hashdigest, ...) are
+    rare and are kept in the _extra dict, which is only created when one is set.
     """
-    # declaring slots prevents other attributes from appearing,
-    # but that prevents the code from working with new XML that has new fields.
-    # __slots__ = ["file_offset","img_offset","len","fill","sector_size"]
+    __slots__ = ["img_offset","file_offset","len","_extra"]
+    _defaults = {'sector_size':512}
+
     def __init__(self,img_offset=None,len=None,file_offset=None):
-        self.img_offset = img_offset
-        self.file_offset = file_offset
-        self.len = len
-        self.sector_size = 512          # default
-        self.hashdigest  = dict()       # 
+        object.__setattr__(self,'img_offset',img_offset)
+        object.__setattr__(self,'file_offset',file_offset)
+        object.__setattr__(self,'len',len)
+        object.__setattr__(self,'_extra',None)
+
+    def __getattr__(self,name):
+        # Only called for names that are not slots
+        if name.startswith('__'):
+            raise AttributeError(name)
+        extra = self._extra
+        if extra is not None and name in extra:
+            return extra[name]
+        if name in byte_run._defaults:
+            return byte_run._defaults[name]
+        if name=='hashdigest':
+            extra = self._setextra(name,dict()) # created on first use
+            return extra[name]
+        raise AttributeError(name)
+
+    def __setattr__(self,name,value):
+        if name in byte_run.__slots__:
+            object.__setattr__(self,name,value)
+        else:
+            self._setextra(name,value)
+
+    def __delattr__(self,name):
+        if name in byte_run.__slots__:
+            object.__delattr__(self,name)
+        elif self._extra is not None and name in self._extra:
+            del self._extra[name]
+        else:
+            raise AttributeError(name)
+
+    def _setextra(self,name,value):
+        if self._extra is None:
+            object.__setattr__(self,'_extra',{})
+        self._extra[name] = value
+        return self._extra
+
+    def __getstate__(self):
+        return (self.img_offset,self.file_offset,self.len,self._extra)
+
+    def __setstate__(self,state):
+        if isinstance(state,dict):
+            # pickled before byte_run had slots
+            state = (state.pop('img_offset',None),state.pop('file_offset',None),
+                     state.pop('len',None),state)
+        (img_offset,file_offset,len,extra) = state
+        byte_run.__init__(self,img_offset,len,file_offset)
+        if extra:
+            object.__setattr__(self,'_extra',dict(extra))
 
     def __cmp__(self,other):
         if self.img_offset != None and other.img_offset != None:
@@ -193,7 +243,7 @@ class byte_run:
         
     def decode_sax_attributes(self,attr):
         for (key,value) in attr.items():
-            if key=='bytes': key=='len' # tag changed name; provide backwards compatiability 
+            if key=='bytes': key='len' # tag changed name; provide backwards compatiability 
             try:
                 setattr(self,key,int(value))
             except ValueError:
@@ -650,32 +700,76 @@ class fileobject:
                 # 
                 # For now, compressed files rely on icat rather than python interface
                 #
-                offset     = safeInt(self.volume.offset)
-                block_size = safeInt(self.volume.block_size)
-                if block_size==0: block_size = 512
-                inode = self.inode()
-                if inode :
-                    block_size = 512
-                    fstype_flag = ""
-                    fstype = self.volume.ftype_str()
-                    if fstype != None:
-                        fstype_flag = '-f' + fstype
-                        cmd = ['icat',fstype_flag,'-b',str(block_size),'-o',str(offset/block_size),imagefile.name,str(inode)]
-                    else:
-                        cmd = ['icat','-b',str(block_size),'-o',str(offset/block_size),imagefile.name,str(inode)]
-                    (data,err) = Popen(cmd, stdout=PIPE,stderr=PIPE).communicate()
-                    # Check for an error
-                    if len(err) > 0 :
-                        raise ValueError("icat error (" + err.strip() + "): "+" ".join(cmd))
-                    return data
-                else :
-                    raise ValueError("Inode missing from file in compressed format.")
+                cmd = self.icat_command(imagefile)
+                (data,err) = Popen(cmd, stdout=PIPE,stderr=PIPE).communicate()
+                # Check for an error
+                if len(err) > 0 :
+                    raise ValueError("icat error (" + err.strip() + "): "+" ".join(cmd))
+                return data
             raise ValueError("Cannot read raw bytes in compressed disk image")
         res = []
         for run in self.byte_runs():
             res.append(self.content_for_run(run=run,imagefile=imagefile))
         return "".join(res)
 
+    def icat_command(self,imagefile=None):
+        """Returns the icat command that extracts the contents of the file from imagefile"""
+        if imagefile is None     : imagefile=self.imagefile
+        offset     = safeInt(self.volume.offset)
+        block_size = safeInt(self.volume.block_size)
+        if block_size==0: block_size = 512
+        inode = self.inode()
+        if not inode:
+            raise ValueError("Inode missing from file in compressed format.")
+        block_size = 512
+        fstype = self.volume.ftype_str()
+        cmd = ['icat']
+        if fstype != None:
+            cmd += ['-f' + fstype]
+        return cmd + ['-b',str(block_size),'-o',str(offset//block_size),imagefile.name,str(inode)]
+
+    def iter_contents(self,chunk_size=1024*1024,overlap=0,imagefile=None):
+        """Returns the contents of the file as an iterator of (file_offset,buffer) windows of
+        at most chunk_size+overlap bytes, without holding the whole file in memory. Each window
+        begins with the last overlap bytes of the one before, so that a match of up to
+        overlap+1 bytes that straddles two chunks is whole in one of the windows."""
+        if imagefile is None     : imagefile=self.imagefile
+        if imagefile is None     : raise ValueError("imagefile is unknown")
+        if self.encrypted()      : raise ValueError("Cannot generate content for encrypted files")
+        return content_windows(self._content_pieces(chunk_size,imagefile),chunk_size,overlap)
+
+    def _content_pieces(self,chunk_size,imagefile):
+        """Yields the contents of the file in pieces of at most chunk_size bytes"""
+        if self.compressed() or imagefile.name.endswith(".aff") or imagefile.name.endswith(".E01"):
+            cmd = self.icat_command(imagefile)
+            p = Popen(cmd,stdout=PIPE,stderr=PIPE)
+            try:
+                while True:
+                    buf = p.stdout.read(chunk_size)
+                    if len(buf)==0: break
+                    yield buf
+                err = p.stderr.read()
+            finally:
+                p.stdout.close()
+                p.wait()
+            if len(err) > 0 :
+                raise ValueError("icat error (" + err.strip() + "): "+" ".join(cmd))
+            return
+        for run in self.byte_runs():
+            if run.len is None or run.len <= 0: continue
+            if hasattr(run,'fill') or run.img_offset is None:
+                fill = bytes(bytearray([getattr(run,'fill',0) or 0]))
+                for pos in range(0,run.len,chunk_size):
+                    yield fill * min(chunk_size,run.len-pos)
+                continue
+            pos = 0
+            while pos < run.len:
+                imagefile.seek(run.img_offset+pos)  # other readers may share imagefile
+                buf = imagefile.read(min(chunk_size,run.len-pos))
+                if len(buf)==0: break
+                yield buf
+                pos += len(buf)
+
     def tempfile(self,calcMD5=False,calcSHA1=False):
         """Return the contents of imagefile in a named temporary file. If
         calcMD5 or calcSHA1 are set TRUE, then the object returned has a
@@ -718,6 +812,25 @@ class fileobject:
     def name_type(self):
         return self.tag("name_type")
 
+def content_windows(pieces,chunk_size,overlap=0):
+    """Yields (offset,buffer) windows over the byte strings in pieces, taken as one stream.
+    Each window holds chunk_size new bytes (the last may hold fewer) after the last overlap
+    bytes of the window before."""
+    window = b""
+    start  = 0                  # stream offset of window[0]
+    kept   = 0                  # bytes at the start of window that were already yielded
+    for piece in pieces:
+        window += piece
+        while len(window)-kept >= chunk_size:
+            end = kept+chunk_size
+            yield (start,window[:end])
+            keep = min(overlap,end)
+            start += end-keep
+            window = window[end-keep:]
+            kept = keep
+    if len(window) > kept:
+        yield (start,window)
+
 class fileobject_dom(fileobject):
     """file objects created through the DOM. Each object has the XML document
     stored in the .doc attribute."""    
@@ -863,15 +976,34 @@ class xml_reader:
         if self.cdata != None:
             self.cdata += data
 
-    def process_xml_stream(self,xml_stream,callback):
-        "Run the reader on a given XML input stream"
-        self.callback = callback
+    def _parser(self):
         import xml.parsers.expat
         p = xml.parsers.expat.ParserCreate()
         p.StartElementHandler  = self._start_element
         p.EndElementHandler    = self._end_element
         p.CharacterDataHandler = self._char_data
-        p.ParseFile(xml_stream)    
+        return p
+
+    def process_xml_stream(self,xml_stream,callback):
+        "Run the reader on a given XML input stream"
+        self.callback = callback
+        self._parser().ParseFile(xml_stream)
+
+    def iter_xml_stream(self,xml_stream,chunk_size=1024*1024):
+        """Returns a generator of the objects the reader would pass to its callback. The stream
+        is fed to expat CHUNK_SIZE bytes at a time, so only the objects completed by one chunk
+        are held at once."""
+        done = []
+        self.callback = done.append
+        p = self._parser()
+        while True:
+            data = xml_stream.read(chunk_size)
+            p.Parse(data,len(data)==0)
+            for obj in done:
+                yield obj
+            del done[:]
+            if len(data)==0:
+                return
 
 class regxml_reader(xml_reader):
     def __init__(self,flags=None):
@@ -1031,14 +1163,18 @@ class fileobject_reader(xml_reader):
     """Class which uses the SAX expat-based XML reader.
     Reads an FIWALK XML input file and automatically creates
     volumeobject_sax and fileobject_sax objects, but just returns the filoeobject
-    objects.."""
-    def __init__(self,imagefile=None,flags=None):
+    objects..
+    If TAGS is given, only the fileobject tags named in it are kept; the others are
+    dropped as they are parsed. Byte runs are always kept, and their hashdigests only
+    if 'hashdigest' is in TAGS."""
+    def __init__(self,imagefile=None,flags=None,tags=None):
         self.creator      = None
         self.volumeobject = None
         self.fileobject   = None
         self.imageobject  = imageobject_sax()
         self.imagefile    = imagefile
         self.flags        = flags
+        self.tags         = None if tags is None else frozenset(tags)
         xml_reader.__init__(self)
         
     def _start_element(self, name, attrs):
@@ -1085,15 +1221,16 @@ class fileobject_reader(xml_reader):
         if name=='hashdigest' and len(self.tagstack)>0:
             top = self.tagstack[-1]            # what the hash was for
             alg = self.hashdigest_type.lower() # name of the hash algorithm used
-            if top=='byte_run':
+            if top=='byte_run' and (self.tags is None or 'hashdigest' in self.tags):
                 self.fileobject._byte_runs[-1].hashdigest[alg] = self.cdata
-            if top=="fileobject":
+            if top=="fileobject" and (self.tags is None or alg in self.tags):
                 self.fileobject._tags[alg] = self.cdata # legacy
                 self.fileobject.hashdigest[alg] = self.cdata
             self.cdata = None
             return
         if self.fileobject:             # in a file object, all tags are remembered
-            self.fileobject._tags[name] = self.cdata
+            if self.tags is None or name in self.tags:
+                self.fileobject._tags[name] = self.cdata
             self.cdata = None
             return
         # Special case: <source><image_filename>fn</image_filename></source>
@@ -1158,21 +1295,35 @@ def combine_runs(runs):
 
 class extentdb:
     """A class to a database of extents and report if they collide.
-    Currently this is not an efficient implementation, but it could become
-    more efficient in the future. When it does, every program that uses
-    this implementation will get faster too!  Each extent is represented
+    The extents are kept sorted by image offset, with a parallel list of their
+    start offsets, so lookups are binary searches. Stored extents never overlap,
+    so the only extents that can intersect a range are the last one starting at
+    or before it and those that start inside it. Each extent is represented
     as a byte_run object"""
     def __init__(self,sectorsize=512):
-        self.db = []                    # the database of runs
-        self.sectorsize = 512
-        pass
-    
+        self.db = []                    # the database of runs, sorted by img_offset
+        self.starts = []                # img_offset of each run in db
+        self.sectorsize = sectorsize
+
+    @classmethod
+    def from_runs(cls,runs,sectorsize=512):
+        """Builds a database from RUNS in one pass. Raises ValueError if two runs intersect."""
+        db = cls(sectorsize)
+        db._insert_sorted(sorted(runs,key=lambda run:run.img_offset))
+        return db
+
+    def __len__(self):
+        return len(self.db)
+
+    def __iter__(self):
+        return iter(self.db)
+
     def report(self,f):
         """Print information about the database"""
         f.write("sectorsize: %d\n" % self.sectorsize)
-        for run in sorted(self.db):
+        for run in self.db:
             f.write("   [@%8d ; %8d]\n" % (run.img_offset,run.len))
-        f.write("total entries in database: %d\n\n" % len(r))
+        f.write("total entries in database: %d\n\n" % len(self.db))
     
     def sectors_for_bytes(self,count):
         """Returns the number of sectors necessary to hold COUNT bytes"""
@@ -1180,7 +1331,7 @@ class extentdb:
     
     def sectors_for_run(self,run):
         """Returns an array of the sectors for a given run"""
-        start_sector = run.img_offset/self.sectorsize
+        start_sector = run.img_offset//self.sectorsize
         sector_count = self.sectors_for_bytes(run.len)
         return range(start_sector,start_sector+sector_count)
 
@@ -1188,16 +1339,23 @@ class extentdb:
         """Returns the run for a specified sector, and optionally a count of sectors"""
         return byte_run(len=count*self.sectorsize,img_offset=sector_number * self.sectorsize)
 
+    def runs_in(self,start,stop):
+        """Yields the extents that intersect the bytes from START up to STOP, in offset order"""
+        i = bisect.bisect_right(self.starts,start)-1
+        if i<0 or self.db[i].img_offset+self.db[i].len<=start:
+            i += 1
+        while i<len(self.db) and self.starts[i]<stop:
+            yield self.db[i]
+            i += 1
+
     def intersects(self,extent):
         """Returns the intersecting extent, or None if there is none"""
         if extent.len==0: return True    # 0 length intersects with everything
         if extent.len<0: raise ValueError("Length cannot be negative:"+str(extent))
         start = extent.img_offset
-        stop  = extent.img_offset+extent.len
-        for d in self.db:
-            if d.img_offset <= start < d.img_offset+d.len: return d
-            if d.img_offset < stop  < d.img_offset+d.len: return d
-            if start<d.img_offset and d.img_offset+d.len <= stop: return d
+        i = bisect.bisect_right(self.starts,start)-1
+        if i>=0 and self.db[i].img_offset+self.db[i].len>start: return self.db[i]
+        if i+1<len(self.starts) and self.starts[i+1]<start+extent.len: return self.db[i+1]
         return None
 
     def intersects_runs(self,runs):
@@ -1219,12 +1377,39 @@ class extentdb:
         v = self.intersects(extent)
         if v:
             raise ValueError("Cannot add "+str(extent)+": it intersects "+str(v))
-        self.db.append(extent)
+        self._insert(extent)
+
+    def _insert(self,extent):
+        i = bisect.bisect_left(self.starts,extent.img_offset)
+        self.starts.insert(i,extent.img_offset)
+        self.db.insert(i,extent)
 
     def add_runs(self,runs):
-        """Adds all of the runs to the extent database"""
+        """Adds all of the runs to the extent database. Raises ValueError,
+        adding none of them, if any intersect each other or the database."""
+        runs = sorted(runs,key=lambda run:run.img_offset)
+        if len(runs)*8 >= len(self.db):
+            self._insert_sorted(runs)   # many runs: merge them in one pass
+            return
+        for (a,b) in zip(runs,runs[1:]):
+            if a.img_offset+a.len>b.img_offset:
+                raise ValueError("Cannot add "+str(b)+": it intersects "+str(a))
+        for r in runs:
+            v = self.intersects(r)
+            if v: raise ValueError("Cannot add "+str(r)+": it intersects "+str(v))
         for r in runs:
-            self.add(r)
+            self._insert(r)
+
+    def _insert_sorted(self,runs):
+        """Merges the sorted RUNS into the database, checking for intersections"""
+        merged = sorted(self.db+runs,key=lambda run:run.img_offset)   # two sorted sequences
+        for (a,b) in zip(merged,merged[1:]):
+            if a.len<=0 or a.img_offset+a.len>b.img_offset:
+                raise ValueError("Cannot add "+str(b)+": it intersects "+str(a))
+        if merged and merged[-1].len<=0:
+            raise ValueError("Cannot add "+str(merged[-1])+": it intersects everything")
+        self.db = merged
+        self.starts = [run.img_offset for run in merged]
 
     def runs_for_sectors(self,sectors):
         """Given a list of SECTORS, return a list of RUNS.
@@ -1239,15 +1424,61 @@ class extentdb:
 
     def sectors_not_in_db(self,run):
         """For a given run, return a list of sectors not in the extent db"""
-        return filter(lambda x:not self.intersects_sector(x),self.sectors_for_run(run))
+        ret = []
+        sectors = self.sectors_for_run(run)
+        if len(sectors)==0: return ret
+        pos = sectors[0]
+        end = sectors[-1]+1
+        for d in self.runs_in(pos*self.sectorsize,end*self.sectorsize):
+            first = d.img_offset//self.sectorsize        # first sector d touches
+            ret.extend(range(pos,min(first,end)))
+            pos = max(pos,self.sectors_for_bytes(d.img_offset+d.len))
+        ret.extend(range(pos,end))
+        return ret
 
+    def _coalesced(self,runs):
+        """Returns the byte ranges covered by the sorted RUNS as a list of [start,stop]"""
+        ret = []
+        for run in runs:
+            if run.len<=0: continue
+            stop = run.img_offset+run.len
+            if ret and run.img_offset<=ret[-1][1]:
+                ret[-1][1] = max(ret[-1][1],stop)
+            else:
+                ret.append([run.img_offset,stop])
+        return ret
 
-def read_dfxml(xmlfile=None,imagefile=None,flags=0,callback=None):
+    def union(self,other):
+        """Returns a new database of the bytes in this database or in OTHER,
+        with overlapping and adjacent extents combined."""
+        runs = sorted(self.db+list(other),key=lambda run:run.img_offset)
+        return extentdb.from_runs([byte_run(img_offset=start,len=stop-start)
+                                   for (start,stop) in self._coalesced(runs)],self.sectorsize)
+
+    def difference(self,other):
+        """Returns a new database of the bytes in this database that are not in OTHER."""
+        if not isinstance(other,extentdb):
+            other = extentdb().union(other)
+        ret = []
+        for d in self.db:
+            pos = d.img_offset
+            stop = d.img_offset+d.len
+            for o in other.runs_in(pos,stop):
+                if o.img_offset>pos:
+                    ret.append(byte_run(img_offset=pos,len=o.img_offset-pos))
+                pos = max(pos,o.img_offset+o.len)
+            if pos<stop:
+                ret.append(byte_run(img_offset=pos,len=stop-pos))
+        return extentdb.from_runs(ret,self.sectorsize)
+
+
+def read_dfxml(xmlfile=None,imagefile=None,flags=0,callback=None,tags=None):
     """Processes an image using expat, calling a callback for every file object encountered.
-    If xmlfile is provided, use that as the xmlfile, otherwise runs fiwalk."""
+    If xmlfile is provided, use that as the xmlfile, otherwise runs fiwalk.
+    If TAGS is given, the file objects only keep the tags named in it."""
     if not callback:
         raise ValueError("callback must be specified")
-    r = fileobject_reader(imagefile=imagefile,flags=flags)
+    r = fileobject_reader(imagefile=imagefile,flags=flags,tags=tags)
     r.process_xml_stream(xmlfile,callback)
     return r
 
@@ -1279,15 +1510,14 @@ def fileobjects_sax(xmlfile=None,imagefile=None,flags=0):
                      callback=lambda fi:ret.append(fi))
     return ret
 
-def fileobjects_iter(xmlfile=None,imagefile=None,flags=0):
+def fileobjects_iter(xmlfile=None,imagefile=None,flags=0,chunk_size=1024*1024,tags=None):
     """Returns an iterator that returns fileobjects extracted from the given
-    imagefile. If XMLFILE is provided, read the objects are read
-    directly from the XML, otherwise this method runs fiwalk with the
-    specified FLAGS."""
-    print("For reasons we do not understand, fileobjects_iter currently does not work.")
-    def local_iter(fi):
-        yield fi
-    read_dfxml(xmlfile=xmlfile,imagefile=imagefile,flags=flags,callback=local_iter)
+    imagefile, read from XMLFILE as they are parsed. Unlike fileobjects_sax,
+    the fileobjects are not collected in a list, so memory use does not grow
+    with the size of the XML. If TAGS is given, the file objects only keep
+    the tags named in it."""
+    r = fileobject_reader(imagefile=imagefile,flags=flags,tags=tags)
+    return r.iter_xml_stream(xmlfile,chunk_size)
 
 def fileobjects_dom(xmlfile=None,imagefile=None,flags=0):
     """Returns a tuple consisting of (XML,LIST) where XML is the
@@ -1311,11 +1541,168 @@ def volumeobjects_sax(xmlfile=None,imagefile=None,flags=0):
     
         
         
+################################################################
+###
+###  SQLite DFXML store
+###
+
+SQLITE_MAGIC = b"SQLite format 3\0"
+
+def is_sqlite_store(f):
+    """Returns True if the open file F (or the file at path F) is a SQLite database, such as a
+    store written by dfxml_store, rather than DFXML."""
+    if not hasattr(f,'read'):
+        with open(f,'rb') as g:
+            return g.read(len(SQLITE_MAGIC))==SQLITE_MAGIC
+    pos = f.tell()
+    magic = f.read(len(SQLITE_MAGIC))
+    f.seek(pos)
+    return magic==SQLITE_MAGIC
+
+class dfxml_store:
+    """An indexed copy of a DFXML file in SQLite. Reading the fileobjects back takes a fraction
+    of the time of parsing the XML, and files can be looked up by name, hash or image offset.
+    Every tag of a fileobject is kept, so the fileobjects behave like the ones read with expat."""
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS volumes (id INTEGER PRIMARY KEY, offset INTEGER,
+                                        block_size INTEGER, tags TEXT);
+    CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, volume INTEGER, filename TEXT,
+                                      filesize INTEGER, md5 TEXT, sha1 TEXT, alloc INTEGER,
+                                      tags TEXT, hashdigest TEXT);
+    CREATE TABLE IF NOT EXISTS runs (file INTEGER, file_offset INTEGER, img_offset INTEGER,
+                                     len INTEGER, extra TEXT);
+    CREATE TABLE IF NOT EXISTS image (name TEXT PRIMARY KEY, value TEXT);
+    """
+    INDEXES = """
+    CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+    CREATE INDEX IF NOT EXISTS files_md5 ON files (md5);
+    CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1);
+    CREATE INDEX IF NOT EXISTS runs_file ON runs (file);
+    CREATE INDEX IF NOT EXISTS runs_img_offset ON runs (img_offset);
+    """
+    def __init__(self,path):
+        import sqlite3
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+        self.volumes = {}       # volumeobject_sax -> row id, while adding; holding the volumes
+                                # keeps them alive, so they cannot be mistaken for one another
+        self._longest_run = None
+
+    def add(self,fi):
+        """Adds a fileobject. Call index() when all have been added."""
+        import json
+        volume = None
+        if getattr(fi,'volume',None) is not None:
+            volume = self.volumes.get(fi.volume)
+            if volume is None:
+                cur = self.db.execute("INSERT INTO volumes (offset,block_size,tags) VALUES (?,?,?)",
+                                      (fi.volume.offset,fi.volume.block_size,
+                                       json.dumps(fi.volume._tags)))
+                volume = self.volumes[fi.volume] = cur.lastrowid
+        alloc = fi.tag("alloc")
+        md5 = fi.tag("md5")
+        sha1 = fi.tag("sha1")
+        cur = self.db.execute("INSERT INTO files (volume,filename,filesize,md5,sha1,alloc,tags,"
+                              "hashdigest) VALUES (?,?,?,?,?,?,?,?)",
+                              (volume,fi.filename(),safeInt(fi.tag("filesize")) or 0,
+                               md5.lower() if md5 else None,sha1.lower() if sha1 else None,
+                               int(alloc) if alloc not in (None,"") else None,
+                               json.dumps(fi._tags),json.dumps(fi.hashdigest)))
+        file_id = cur.lastrowid
+        self.db.executemany("INSERT INTO runs (file,file_offset,img_offset,len,extra) "
+                            "VALUES (?,?,?,?,?)",
+                            [(file_id,run.file_offset,run.img_offset,run.len,
+                              json.dumps(run._extra) if run._extra else None)
+                             for run in fi.byte_runs()])
+
+    def index(self):
+        """Builds the lookup indexes, records the longest run for at_offset, and commits"""
+        self.db.executescript(self.INDEXES)
+        self.db.execute("INSERT OR REPLACE INTO image (name,value) "
+                        "SELECT 'longest_run',coalesce(max(len),0) FROM runs")
+        self.db.commit()
+        self._longest_run = None
+
+    def _fileobjects(self,sql,args,imagefile):
+        import json
+        volumes = {}
+        for (vid,offset,block_size,tags) in self.db.execute(
+                "SELECT id,offset,block_size,tags FROM volumes"):
+            v = volumes[vid] = volumeobject_sax()
+            v.offset = offset
+            v.block_size = block_size
+            v._tags = json.loads(tags)
+        runs = self.db.execute("SELECT file,file_offset,img_offset,len,extra FROM runs "
+                               "WHERE file IN (SELECT id FROM files "+sql+") ORDER BY file,rowid",
+                               args)
+        pending = runs.fetchone()
+        for (file_id,vid,tags,hashdigest) in self.db.execute(
+                "SELECT id,volume,tags,hashdigest FROM files "+sql+" ORDER BY id",args):
+            fi = fileobject_sax(imagefile=imagefile)
+            fi.volume = volumes.get(vid)
+            fi._tags = json.loads(tags)
+            fi.hashdigest = json.loads(hashdigest)
+            # Both queries are in file id order, so the runs are merged in, not looked up
+            while pending is not None and pending[0]==file_id:
+                b = byte_run(pending[2],pending[3],pending[1])
+                if pending[4] is not None:
+                    for (key,value) in json.loads(pending[4]).items():
+                        setattr(b,key,value)
+                fi._byte_runs.append(b)
+                pending = runs.fetchone()
+            yield fi
+
+    def fileobjects(self,imagefile=None):
+        """Yields every fileobject, in DFXML order"""
+        return self._fileobjects("",(),imagefile)
+
+    def by_name(self,filename,imagefile=None):
+        """Yields the fileobjects with the given filename"""
+        return self._fileobjects("WHERE filename=?",(filename,),imagefile)
+
+    def by_md5(self,md5,imagefile=None):
+        return self._fileobjects("WHERE md5=?",(md5.lower(),),imagefile)
+
+    def by_sha1(self,sha1,imagefile=None):
+        return self._fileobjects("WHERE sha1=?",(sha1.lower(),),imagefile)
+
+    def at_offset(self,img_offset,imagefile=None):
+        """Yields the fileobjects with a byte run covering IMG_OFFSET in the image"""
+        return self._fileobjects("WHERE id IN (SELECT file FROM runs WHERE img_offset<=? AND "
+                                 "img_offset+len>? AND img_offset>=?)",
+                                 (img_offset,img_offset,img_offset-self.longest_run()),
+                                 imagefile)
+
+    def longest_run(self):
+        """Returns the length of the longest run, as recorded by index()"""
+        if self._longest_run is None:
+            row = self.db.execute("SELECT value FROM image WHERE name='longest_run'").fetchone()
+            if row is None:
+                row = self.db.execute("SELECT max(len) FROM runs").fetchone()  # not indexed yet
+            self._longest_run = int(row[0] or 0)
+        return self._longest_run
+
+    def close(self):
+        self.db.close()
+
+def dfxml_to_sqlite(xmlfile,path,imagefile=None):
+    """Reads the DFXML in the open file XMLFILE into a new dfxml_store at PATH and returns it"""
+    import os
+    if os.path.exists(path):
+        os.remove(path)
+    store = dfxml_store(path)
+    read_dfxml(xmlfile=xmlfile,imagefile=imagefile,callback=store.add)
+    store.index()
+    return store
+
 ################################################################
 if __name__=="__main__":
     from optparse import OptionParser
     parser = OptionParser()
     parser.add_option("-r","--regress",action="store_true")
+    parser.add_option("--sqlite",metavar="DB",
+                      help="convert the DFXML file given as argument into an indexed SQLite store")
     (options,args) = parser.parse_args()
 
     def check_equal(a,b,want=None):
@@ -1387,3 +1774,9 @@ if __name__=="__main__":
         assert db.intersects(byte_run(-1,1))==None
         assert db.intersects(byte_run(10,1))==None
         print("Overlap engine good!")
+
+    if options.sqlite:
+        if len(args)!=1:
+            parser.error("--sqlite needs the DFXML file to convert")
+        with open(args[0],'rb') as xmlfile:
+            dfxml_to_sqlite(xmlfile,options.sqlite).close()
@@ -172,10 +172,83 @@ def E01_glob(fn):
     return ret
 
 
-def fiwalk_xml_stream(imagefile=None,flags=0,fiwalk="fiwalk",fiwalk_args=""):
-    """ Returns an fiwalk XML stream given a disk image by running fiwalk."""
+DFXML_CACHE_SAMPLES = 64
+
+def image_fingerprint(path,samples=DFXML_CACHE_SAMPLES,sector_size=512):
+    """Returns a digest of the path, size and mtime of an image and of SAMPLES of its sectors,
+    spread evenly from the first sector to the last."""
+    import os,hashlib
+    st = os.stat(path)
+    h = hashlib.sha1()
+    h.update(("%s\t%d\t%d\n" % (os.path.abspath(path),st.st_size,int(st.st_mtime))).encode('utf-8'))
+    last = max(st.st_size-1,0) // sector_size
+    with open(path,'rb') as f:
+        for i in range(samples):
+            f.seek((last * i // max(samples-1,1)) * sector_size)
+            h.update(f.read(sector_size))
+    return h.hexdigest()
+
+def dfxml_cache_path(cache_dir,imagefile,fiwalk_args=""):
+    """Returns the path of the DFXML cache file for an image walked with fiwalk_args"""
+    import os,hashlib
+    key = image_fingerprint(imagefile.name) + "\t" + fiwalk_args
+    return os.path.join(cache_dir,hashlib.sha1(key.encode('utf-8')).hexdigest()+".xml")
+
+class tee_stream:
+    """Reads the XML from a fiwalk process and copies it to a DFXML cache file. The copy is
+    written to a temporary file that commit() renames into place once the XML has been parsed
+    and fiwalk has exited cleanly, so the cache never holds a partial walk."""
+    def __init__(self,process,path):
+        import os
+        self.process = process
+        self.path    = path
+        self.tmppath = "%s.%d.tmp" % (path,os.getpid())
+        self.out     = open(self.tmppath,'wb')
+
+    def read(self,size=-1):
+        data = self.process.stdout.read(size)
+        if self.out is not None:
+            self.out.write(data)
+        return data
+
+    def commit(self):
+        """Keeps the copy in the cache if fiwalk exited cleanly, or else discards it. Call it
+        once the parser has consumed the XML."""
+        import os
+        while len(self.read(1024*1024))>0:
+            pass                # whatever follows the end of the document
+        out = self.out
+        self.out = None
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        if self.process.wait()==0:
+            os.rename(self.tmppath,self.path)
+        else:
+            os.remove(self.tmppath)
+
+    def close(self):
+        """Closes the stream; the cache file is discarded unless it was complete"""
+        import os
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+            os.remove(self.tmppath)
+        self.process.stdout.close()
+
+def fiwalk_xml_stream(imagefile=None,flags=0,fiwalk="fiwalk",fiwalk_args="",cache_dir=None):
+    """ Returns an fiwalk XML stream given a disk image by running fiwalk.
+    If cache_dir is given, the XML is also saved there, and later calls for the same image
+    (path, size, mtime and a sample of its sectors) and arguments read it instead."""
     if flags & ALLOC_ONLY: fiwalk_args += "-O"
     from subprocess import call,Popen,PIPE
+    if cache_dir is not None:
+        import os
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        path = dfxml_cache_path(cache_dir,imagefile,fiwalk_args)
+        if os.path.exists(path):
+            return open(path,'rb')
     # Make sure we have a valid fiwalk
     try:
         res = Popen([fiwalk,'-V'],stdout=PIPE).communicate()[0]
@@ -184,17 +257,37 @@ def fiwalk_xml_stream(imagefile=None,flags=0,fiwalk="fiwalk",fiwalk_args=""):
     cmd = [fiwalk,'-x']
     if fiwalk_args: cmd += [fiwalk_args]
     p = Popen(cmd + E01_glob(imagefile.name),stdout=PIPE)
+    if cache_dir is not None:
+        return tee_stream(p,path)
     return p.stdout
 
-def fiwalk_using_sax(imagefile=None,xmlfile=None,fiwalk="fiwalk",flags=0,callback=None,fiwalk_args=""):
+def fiwalk_using_sax(imagefile=None,xmlfile=None,fiwalk="fiwalk",flags=0,callback=None,fiwalk_args="",tags=None,cache_dir=None):
     """Processes an image using expat, calling a callback for every file object encountered.
+    If xmlfile is provided, use that as the xmlfile, otherwise runs fiwalk.
+    If tags is given, the file objects only keep the tags named in it.
+    If cache_dir is given, the fiwalk output is cached there (see fiwalk_xml_stream)."""
+    import dfxml
+    if xmlfile!=None:
+        stream = None
+    else:
+        xmlfile = stream = fiwalk_xml_stream(imagefile=imagefile,flags=flags,fiwalk=fiwalk,fiwalk_args=fiwalk_args,cache_dir=cache_dir)
+    r = dfxml.fileobject_reader(flags=flags,tags=tags)
+    r.imagefile = imagefile
+    try:
+        r.process_xml_stream(xmlfile,callback)
+        if isinstance(stream,tee_stream):
+            stream.commit()
+    finally:
+        if stream!=None:
+            stream.close()  # discards a partial cache file
+
+def fiwalk_iter(imagefile=None,xmlfile=None,fiwalk="fiwalk",flags=0,fiwalk_args="",tags=None):
+    """Returns an iterator of the file objects of an image, yielded as they are parsed.
     If xmlfile is provided, use that as the xmlfile, otherwise runs fiwalk."""
     import dfxml
     if xmlfile==None:
         xmlfile = fiwalk_xml_stream(imagefile=imagefile,flags=flags,fiwalk=fiwalk,fiwalk_args=fiwalk_args)
-    r = dfxml.fileobject_reader(flags=flags)
-    r.imagefile = imagefile
-    r.process_xml_stream(xmlfile,callback)
+    return dfxml.fileobjects_iter(xmlfile=xmlfile,imagefile=imagefile,flags=flags,tags=tags)
 
 def fiwalk_vobj_using_sax(imagefile=None,xmlfile=None,fiwalk="fiwalk",flags=0,callback=None):
     """Processes an image using expat, calling a callback for every file object encountered.
@@ -2,6 +2,7 @@ import json
 import logging
 from json import JSONEncoder
 from .rule import redact_rule
+from .plan import redaction_plan
 
 first = True
 
@@ -28,6 +29,10 @@ audit_logger = logging.getLogger('audit_report')
 
 
 class redact_action():
+    """Instances of this class are objects that specify how a redaction should be done."""
+
+    reads_image = False   # True when the redacted bytes depend on the original bytes
+
     def log(self, fileinfo, rule, commit, rundata):
         data = {}
         data['filename'] = fileinfo.filename()
@@ -36,29 +41,41 @@ class redact_action():
         data['runs'] = rundata
         audit_logger.info(_(data))
 
-    """Instances of this class are objects that specify how a redaction should be done."""
+    def redacted_bytes(self, length, original=None):
+        """Returns the LENGTH bytes that replace the ORIGINAL bytes of an extent"""
+        raise ValueError(
+            "redacted_bytes method of redact_action super class should not be called")
+
+    def plan(self, rule, fi, plan, priority=0, commit=True, runs=None):
+        """Adds the runs of the file that the rule selects to the redaction plan and logs them.
+        The runs are taken from the rule unless they were already computed."""
+        if runs is None:
+            runs = rule.runs_to_redact(fi)
+        runlist = []
+        for run in runs:
+            if run.img_offset is None:
+                logging.debug("Skipping byte run without an image offset: %s" % run)
+                continue
+            plan.add(run.img_offset, run.len, self, priority)
+            runlist.append({'file_offset': run.file_offset,
+                            'image_offset': run.img_offset,
+                            'length': run.len})
+        self.log(fi, rule, commit, runlist)
 
     def redact(self, rule, fi, imagefile, commit):
-        """Performs the redaction"""
-        raise ValueError(
-            "redact method of redact_action super class should not be called")
+        """Performs the redaction immediately"""
+        plan = redaction_plan()
+        self.plan(rule, fi, plan, commit=commit)
+        if commit:
+            plan.apply(imagefile)
 
 
 class action_scrub(redact_action):
 
     """ Perform redaction by scrub, meaning fill with null character (hex 0x00)"""
 
-    def redact(self, rule, fi, imagefile, commit):
-        runlist = []
-        val = chr(0)
-        for run in rule.runs_to_redact(fi):
-            if commit:
-                imagefile.seek(run.img_offset)
-                imagefile.write(val * run.len)
-            runlist.append({'file_offset': run.file_offset,
-                            'image_offset': run.img_offset,
-                            'length': run.len})
-        self.log(fi, rule, commit, runlist)
+    def redacted_bytes(self, length, original=None):
+        return b'\0' * length
 
     def __str__(self):
         return 'Scrub (fill with null char, %s)' % '0x00'
@@ -71,16 +88,8 @@ class action_fill(redact_action):
     def __init__(self, val):
         self.fillvalue = val
 
-    def redact(self, rule, fi, imagefile, commit):
-        runlist = []
-        for run in rule.runs_to_redact(fi):
-            if commit:
-                imagefile.seek(run.img_offset)
-                imagefile.write(chr(self.fillvalue) * run.len)
-            runlist.append({'file_offset': run.file_offset,
-                            'image_offset': run.img_offset,
-                            'length': run.len})
-        self.log(fi, rule, commit, runlist)
+    def redacted_bytes(self, length, original=None):
+        return bytes(bytearray([self.fillvalue])) * length
 
     def __str__(self):
         return 'Fill with %s' % hex(self.fillvalue)
@@ -90,39 +99,20 @@ class action_fuzz(redact_action):
 
     """ Perform redaction by fuzzing x86 instructions """
 
-    def redact(self, rule, fi, imagefile, commit):
+    reads_image = True
+
+    def redacted_bytes(self, length, original=None):
         '''
         The net effect of this function is that bytes 127-255 are "fuzzed" over
         the range of 159-191, with each series of four bytes
         (e.g. 128-131) to one byte value (e.g. 160).
         '''
-        runlist = []
-
-        def fuzz(ch):
-            o = ord(ch)
-            if(o < 127):
-                r = ch
-            else:
-                r = chr(((o >> 2) + 128) % 256)
-            return r
-        for run in rule.runs_to_redact(fi):
-            try:
-                imagefile.seek(run.img_offset)
-
-                # Previously redacted only first 10 bytes, now redacts entire sequence
-                # first_ten_bytes = rc.imagefile.read(10)
-                run_bytes = imagefile.read(run.len)
-                newbytes = "".join([fuzz(x) for x in run_bytes])
-                assert(len(newbytes) == run.len)
-                if commit:
-                    imagefile.seek(run.img_offset)
-                    imagefile.write(newbytes)
-                runlist.append({'file_offset': run.file_offset,
-                                'image_offset': run.img_offset,
-                                'length': run.len})
-            except AttributeError:
-                logging.warn("!AttributeError: no byte run?")
-        self.log(fi, rule, commit, runlist)
+        newbytes = bytearray(original)
+        for (i, o) in enumerate(newbytes):
+            if o >= 127:
+                newbytes[i] = ((o >> 2) + 128) % 256
+        assert(len(newbytes) == length)
+        return bytes(newbytes)
 
     def __str__(self):
         return 'Fuzz'
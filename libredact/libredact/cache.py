@@ -0,0 +1,137 @@
+'''Incremental redaction cache
+
+Keeps what a Redactor run learned about an image in a SQLite database, so that the next run over
+the same image with an edited configuration does not walk the image again, and only evaluates the
+content rules that are new or changed. There is one database per image, in the cache directory.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import dfxml
+
+FORMAT = '2'   # of the rows below; a cache in another format is emptied
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS volumes (id INTEGER PRIMARY KEY, offset INTEGER, block_size INTEGER,
+                                    tags TEXT);
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, volume INTEGER, tags TEXT,
+                                  hashdigest TEXT, runs TEXT);
+CREATE TABLE IF NOT EXISTS decisions (rule TEXT, file INTEGER, runs TEXT,
+                                      PRIMARY KEY (rule, file));
+"""
+
+
+def _identity(path):
+    st = os.stat(path)
+    return '%s\t%d\t%d' % (os.path.abspath(path), st.st_size, int(st.st_mtime))
+
+
+class redaction_cache:
+
+    """The cache of one image. It holds the fileobjects of the walk, in walk order, and for each
+    file the decision of every content rule that was evaluated, keyed by the text of the rule
+    line. A decision is the list of byte runs the rule selected, or None if it did not match.
+    Fileobjects are kept as JSON tags and runs, like in a dfxml.dfxml_store."""
+
+    def __init__(self, directory, image_path, dfxml_path=None):
+        key = _identity(image_path)
+        if dfxml_path is not None:
+            key += '\t' + _identity(dfxml_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory,
+                                 hashlib.sha1(key.encode('utf-8')).hexdigest() + '.sqlite')
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'format'").fetchone()
+        if row is None or row[0] != FORMAT:
+            self.db.executescript("DROP TABLE IF EXISTS volumes; DROP TABLE IF EXISTS files; "
+                                  "DROP TABLE IF EXISTS decisions; DELETE FROM meta;")
+            self.db.execute("INSERT INTO meta (name, value) VALUES ('format', ?)", (FORMAT,))
+        self.db.executescript(SCHEMA)
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'walked'").fetchone()
+        self.walked = row is not None
+        if not self.walked:
+            # An unfinished walk cannot be trusted, and decisions are keyed by its file ids
+            self.db.execute("DELETE FROM volumes")
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM decisions")
+        self.next_id = 0
+        self.volumes = {}   # volumeobject_sax: row id, while the walk is added
+        logging.debug("Redaction cache %s (%s)" %
+                      (self.path, 'walked' if self.walked else 'empty'))
+
+    def fileobjects(self, imagefile):
+        """Yields the cached fileobjects in walk order, reading from IMAGEFILE."""
+        volumes = {}
+        for (volume_id, offset, block_size, tags) in self.db.execute(
+                "SELECT id, offset, block_size, tags FROM volumes"):
+            volume = volumes[volume_id] = dfxml.volumeobject_sax()
+            volume.offset = offset
+            volume.block_size = block_size
+            volume._tags = json.loads(tags)
+        for (file_id, volume_id, tags, hashdigest, runs) in self.db.execute(
+                "SELECT id, volume, tags, hashdigest, runs FROM files ORDER BY id"):
+            fileobject = dfxml.fileobject_sax(imagefile=imagefile)
+            fileobject.volume = volumes.get(volume_id)
+            fileobject._tags = json.loads(tags)
+            fileobject.hashdigest = json.loads(hashdigest)
+            for (img_offset, length, file_offset, extra) in json.loads(runs):
+                run = dfxml.byte_run(img_offset, length, file_offset)
+                for (name, value) in (extra or {}).items():
+                    setattr(run, name, value)
+                fileobject._byte_runs.append(run)
+            fileobject.cache_id = file_id
+            yield fileobject
+
+    def add(self, fileobject):
+        """Adds a fileobject from the walk that is under way."""
+        volume_id = None
+        volume = getattr(fileobject, 'volume', None)
+        if volume is not None:
+            volume_id = self.volumes.get(volume)
+            if volume_id is None:
+                cur = self.db.execute("INSERT INTO volumes (offset, block_size, tags) "
+                                      "VALUES (?, ?, ?)", (volume.offset, volume.block_size,
+                                                           json.dumps(volume._tags)))
+                volume_id = self.volumes[volume] = cur.lastrowid
+        runs = [[run.img_offset, run.len, run.file_offset, run._extra]
+                for run in fileobject.byte_runs()]
+        fileobject.cache_id = self.next_id
+        self.db.execute("INSERT INTO files (id, volume, tags, hashdigest, runs) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (self.next_id, volume_id, json.dumps(fileobject._tags),
+                         json.dumps(fileobject.hashdigest), json.dumps(runs)))
+        self.next_id += 1
+
+    def finish_walk(self):
+        """Marks the walk as complete, so that the next run reads it from the cache."""
+        self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('walked', '1')")
+        self.db.commit()
+        self.walked = True
+
+    def decisions(self, fileobject):
+        """Returns the decisions cached for FILEOBJECT as a dict of rule line to runs."""
+        ret = {}
+        for (rule, runs) in self.db.execute("SELECT rule, runs FROM decisions WHERE file = ?",
+                                            (fileobject.cache_id,)):
+            if runs is not None:
+                runs = [dfxml.byte_run(img_offset, length, file_offset)
+                        for (img_offset, length, file_offset) in json.loads(runs)]
+            ret[rule] = runs
+        return ret
+
+    def store(self, fileobject, rule, runs):
+        """Stores the decision of RULE for FILEOBJECT."""
+        if runs is not None:
+            runs = json.dumps([[run.img_offset, run.len, run.file_offset] for run in runs])
+        self.db.execute("INSERT OR REPLACE INTO decisions (rule, file, runs) VALUES (?, ?, ?)",
+                        (rule.line, fileobject.cache_id, runs))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,124 @@
+'''Checkpoints for long-running redactions
+
+A checkpoint records how far a Redactor run has got, so that a run that dies can be resumed with
+--resume instead of starting over. It is kept in two files: a small JSON state file that is
+replaced atomically, and an append-only journal of the redactions found so far.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+VERSION = 1
+
+
+def file_identity(path):
+    """Returns the facts used to recognise the output image when resuming"""
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'dev': st.st_dev,
+            'ino': st.st_ino}
+
+
+class checkpoint:
+
+    """The checkpoint of one redaction run. The state holds the stage ('evaluate' or 'apply'), the
+    number of fileobjects walked, the length of the journal that goes with it, and during the
+    apply stage the image offset up to which the plan was written."""
+
+    interval = 60   # seconds between saves
+
+    def __init__(self, path, config_hash):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.config_hash = config_hash
+        self.state = None
+        self.journal = None
+        self.saved = 0
+
+    @staticmethod
+    def hash_config(conf):
+        """Returns a digest of the settings that decide what is redacted"""
+        h = hashlib.sha1()
+        for (rule, action) in conf['rules']:
+            h.update(('%s\t%s\n' % (rule, action)).encode('utf-8'))
+        h.update(conf['ignore_patterns'].pattern.encode('utf-8'))
+        h.update(os.path.abspath(conf['input_file'].name).encode('utf-8'))
+        if conf.get('allocated_only'):
+            h.update(b'\tallocated only')
+        return h.hexdigest()
+
+    def load(self, output_path=None):
+        """Returns the journal records of a checkpoint that this run can resume, or None. The
+        configuration must be the same, and the output image, if given, must be the same file."""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning('Cannot resume, no usable checkpoint at %s (%s)' % (self.path, e))
+            return None
+        if state.get('version') != VERSION or state.get('config') != self.config_hash:
+            logging.warning('Cannot resume, the checkpoint was made with another configuration')
+            return None
+        if output_path is not None and \
+                (not os.path.exists(output_path) or
+                 state.get('output') != file_identity(output_path)):
+            logging.warning('Cannot resume, the output image is not the checkpointed one')
+            return None
+        records = []
+        with open(self.journal_path, 'rb') as f:
+            data = f.read(state['journal_size'])
+        for line in data.splitlines():
+            records.append(json.loads(line.decode('utf-8')))
+        self.state = state
+        return records
+
+    def start(self, output_path=None):
+        """Begins recording, keeping the part of the journal covered by a loaded state"""
+        if self.state is None:
+            self.state = {'version': VERSION, 'config': self.config_hash, 'output': None,
+                          'stage': 'evaluate', 'files': 0, 'journal_size': 0, 'applied': 0}
+        if output_path is not None:
+            self.state['output'] = file_identity(output_path)
+        mode = 'r+b' if os.path.exists(self.journal_path) else 'wb'
+        self.journal = open(self.journal_path, mode)
+        self.journal.truncate(self.state['journal_size'])
+        self.journal.seek(self.state['journal_size'])
+        self.saved = time.time()
+
+    def record(self, priority, filename, runs):
+        """Appends a redaction to the journal"""
+        runs = [[run.img_offset, run.len, run.file_offset] for run in runs]
+        line = json.dumps([priority, filename, runs]) + '\n'
+        self.journal.write(line.encode('utf-8'))
+
+    def update(self, outputfile=None, **progress):
+        """Updates the state, saving it if the interval has passed since the last save. Writes to
+        OUTPUTFILE are made durable before a state that counts them is saved."""
+        self.state.update(progress)
+        if time.time() - self.saved >= self.interval:
+            if outputfile is not None:
+                outputfile.flush()
+                os.fsync(outputfile.fileno())
+            self.save()
+
+    def save(self):
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.state['journal_size'] = self.journal.tell()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)   # atomic replace
+        self.saved = time.time()
+
+    def remove(self):
+        """Deletes the checkpoint once the run has finished"""
+        if self.journal is not None:
+            self.journal.close()
+        for path in [self.path, self.journal_path]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,6 +1,6 @@
 """Usage:
-  redact-cli [-nqd] -c FILE
-  redact-cli [-nqd] [--input=FILE] [--output=FILE] [--dfxml=FILE] [--report=FILE] --config=FILE
+  redact-cli [-nqdsrwa] -c FILE
+  redact-cli [-nqdsrwa] [--input=FILE] [--output=FILE] [--dfxml=FILE] [--report=FILE] [--metrics=FILE] [--prometheus=FILE] [--cache=DIR] [--dfxml-cache=DIR] [--jobs=N] --config=FILE
   redact-cli -h | --help
   redact-cli -H
   redact-cli -v | --version
@@ -11,10 +11,24 @@ how to redact it. Prints a summary of actions taken to standard output.
 Options:
   -c, --config=FILE      configuration file specifies redaction settings (see -H for details)
   -i, --input=FILE       disk image file to redact (or use file specified by --config)
-  -o, --output=FILE      file location for output redacted image file (required for COMMIT)
-  --dfxml=FILE           previously generated dfxml file (or use file specified by --config)
+  -o, --output=FILE      file location for output redacted image file (required for COMMIT),
+                         or '-' to write the redacted image to standard output (requires --stream)
+  --dfxml=FILE           previously generated dfxml file (or use file specified by --config),
+                         or a SQLite store made from it with dfxml.py --sqlite, which loads faster
   --report=FILE          create an audit report of redactions performed
+  --metrics=FILE         write time, bytes, files and hits per phase and per rule as JSON
+  --prometheus=FILE      write the same metrics for the Prometheus textfile collector (*.prom)
+  --cache=DIR            keep the walk and the content rule decisions in DIR, so that runs after
+                         a configuration edit only evaluate the new rules (same as CACHE_DIR)
+  --dfxml-cache=DIR      save the fiwalk output in DIR and reuse it on later runs over the same
+                         image (same as DFXML_CACHE_DIR; defaults to the --cache directory)
   -n, --dry-run          creates report without taking action ( overrides COMMIT in --config)
+  -s, --stream           copy and redact the image in a single streaming pass (same as STREAM)
+  -a, --allocated-only   only redact allocated files (same as ALLOCATED_ONLY)
+  -w, --parallel-walk    run one fiwalk per partition at the same time (same as PARALLEL_WALK)
+  -r, --resume           resume an interrupted COMMIT run from the checkpoint kept beside the
+                         output image (OUTPUT.checkpoint)
+  -j, --jobs=N           evaluate rules in N worker processes, largest files first [default: 1]
   -q, --quiet            quiet mode (no console output unless errors occur)
   -d, --detail           detail mode, prints individual actions taken (or planned in dry runs)
   -h, --help             show this usage information
@@ -40,11 +54,26 @@ does not matter.
 Simple Commands:
   INPUT_FILE <file path>     path to disk image file to redact
   OUTPUT_FILE <file path>    path to write the redacted disk image
-  DFXML_FILE <file path>     optional path to previously generated DFXML
+  DFXML_FILE <file path>     optional path to previously generated DFXML, or to a SQLite store
+                             made from it with: python dfxml.py --sqlite STORE DFXML
   REPORT_FILE <file path>    optional path to write audit report file
   IGNORE <pattern>           ignore files whose names match regex (repeatable)
+  METRICS_FILE <file path>   optional path to write run metrics as JSON (per phase and per rule)
+  PROMETHEUS_FILE <path>     optional path to write run metrics for the Prometheus textfile
+                             collector
+  CACHE_DIR <directory>      optional directory for the redaction cache, which keeps the files found
+                             in each image and the decisions of the content rules between runs
+  DFXML_CACHE_DIR <dir>      optional directory where the fiwalk output is saved and reused for
+                             the same image (default: CACHE_DIR)
+  CONTENT_CACHE_MB <size>    largest file contents held in memory for content rules (default 128);
+                             larger files are spooled to a memory-mapped temporary file
   COMMIT                     perform all redactions
     (no COMMIT line is equivalent to --dry-run option, will report but not perform the redactions)
+  STREAM                     plan redactions from the input image, then copy it to the output in
+                             one streaming pass (OUTPUT_FILE may then be '-' for standard output)
+  ALLOCATED_ONLY             only redact allocated files; deleted and orphan files are left alone
+  PARALLEL_WALK              run one fiwalk per partition at the same time (raw images on a file
+                             system with reflinks, such as btrfs or XFS; otherwise one fiwalk runs)
 
 Rule Command Format:
   [target condition] [action]
@@ -55,8 +84,8 @@ Target Conditions:
   FILE_NAME_EQUAL <filename> - target a file with the given filename
   FILE_NAME_MATCH <pattern> - target any file with a given filename pattern
   FILE_DIRNAME_EQUAL <directory> - target all files in the directory
-  FILE_MD5 <md5> - target any file with the given md5
-  FILE_SHA1 <sha1> - target any file with the given sha1
+  FILE_MD5 <md5>[:<size>] - target any file with the given md5 (and size)
+  FILE_SHA1 <sha1>[:<size>] - target any file with the given sha1 (and size)
   FILE_SEQ_EQUAL <string> - target any file that contains <a string>
   FILE_SEQ_MATCH <pattern> - target any file that contains a sequence matching <a pattern>
   SEQ_EQUAL <string> - target any sequences equal to <a string>
@@ -111,8 +140,25 @@ def main():
         cfg['dfxml_file'] = args.get('--dfxml')
     if args.get('--report'):
         cfg['report_file'] = args.get('--report')
+    if args.get('--metrics'):
+        cfg['metrics_file'] = args.get('--metrics')
+    if args.get('--prometheus'):
+        cfg['prometheus_file'] = args.get('--prometheus')
+    if args.get('--cache'):
+        cfg['cache_dir'] = args.get('--cache')
+    if args.get('--dfxml-cache'):
+        cfg['dfxml_cache_dir'] = args.get('--dfxml-cache')
     if args.get('--dry-run'):  # if True then override COMMIT
         cfg['commit'] = False
+    if args.get('--stream'):
+        cfg['stream'] = True
+    if args.get('--allocated-only'):
+        cfg['allocated_only'] = True
+    if args.get('--parallel-walk'):
+        cfg['parallel_walk'] = True
+    if args.get('--resume'):
+        cfg['resume'] = True
+    cfg['jobs'] = int(args.get('--jobs'))
 
     # TODO cfg['detail'] = args.get('--detail')
 
@@ -0,0 +1,135 @@
+'''Output image cloning
+
+Copies the input image to the output so that the copy shares as much as possible with the source.
+A reflink clone is tried first (btrfs, XFS), then a kernel-side copy_file_range of the data
+extents, then a chunked read/write of the data extents. Holes in sparse images are never filled.
+'''
+
+import errno
+import logging
+import os
+import shutil
+import sys
+
+FICLONE = 0x40049409   # _IOW(0x94, 9, int) from linux/fs.h
+FICLONERANGE = 0x4020940d   # _IOW(0x94, 13, struct file_clone_range)
+CHUNK_SIZE = 1024 * 1024 * 64
+if sys.platform.startswith('linux'):
+    SEEK_DATA = getattr(os, 'SEEK_DATA', 3)   # values from linux/fs.h, for Python 2
+    SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+else:
+    SEEK_DATA = getattr(os, 'SEEK_DATA', None)
+    SEEK_HOLE = getattr(os, 'SEEK_HOLE', None)
+
+# errno values meaning "not supported here", as opposed to a real I/O failure
+_UNSUPPORTED = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                    errno.EBADF, errno.EPERM, errno.ETXTBSY])
+
+
+def clone_file(src, dst):
+    """Copies the file at path SRC to path DST and copies the permission bits, like shutil.copy.
+    Returns the method that was used: 'reflink', 'copy_file_range' or 'sparse'."""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            method = clone_fd(fsrc.fileno(), fdst.fileno())
+    shutil.copymode(src, dst)
+    logging.debug("Copied %s to %s by %s" % (src, dst, method))
+    return method
+
+
+def clone_fd(src_fd, dst_fd):
+    """Copies the open file SRC_FD into the empty, open file DST_FD."""
+    if reflink(src_fd, dst_fd):
+        return 'reflink'
+    size = os.fstat(src_fd).st_size
+    use_kernel = hasattr(os, 'copy_file_range')
+    for (start, end) in data_extents(src_fd, size):
+        use_kernel = copy_extent(src_fd, dst_fd, start, end, use_kernel)
+    os.ftruncate(dst_fd, size)   # restores a trailing hole
+    if use_kernel:
+        return 'copy_file_range'
+    return 'sparse'
+
+
+def reflink(src_fd, dst_fd):
+    """Makes DST_FD share all of the blocks of SRC_FD. Returns False if the file system or the
+    platform cannot do it."""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+
+
+def reflink_range(src_fd, dst_fd, src_offset, length, dst_offset=0):
+    """Makes LENGTH bytes of DST_FD at DST_OFFSET share the blocks of SRC_FD at SRC_OFFSET. The
+    offsets must be multiples of the file system block size, and so must LENGTH unless the range
+    ends at the end of SRC_FD. Returns False if the file system or the platform cannot do it."""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    import struct
+    arg = struct.pack('qQQQ', src_fd, src_offset, length, dst_offset)
+    try:
+        fcntl.ioctl(dst_fd, FICLONERANGE, arg)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+
+
+def data_extents(fd, size):
+    """Yields the (start, end) ranges of FD that hold data. Where the OS cannot report holes
+    this is the whole file."""
+    pos = 0
+    while pos < size:
+        if SEEK_DATA is None:
+            yield (pos, size)
+            return
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return   # only a hole remains
+            if e.errno in _UNSUPPORTED:
+                yield (pos, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        yield (start, end)
+        pos = end
+
+
+def copy_extent(src_fd, dst_fd, start, end, use_kernel=True):
+    """Copies the bytes from START to END at the same offsets, in chunks of CHUNK_SIZE. Uses
+    copy_file_range while USE_KERNEL is set and the kernel accepts it. Returns whether the kernel
+    copy may still be used for the next extent."""
+    pos = start
+    while pos < end:
+        count = min(end - pos, CHUNK_SIZE)
+        if use_kernel:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, count, pos, pos)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                logging.debug("copy_file_range unavailable (%s), copying through userspace" % e)
+                use_kernel = False
+                continue
+        else:
+            os.lseek(src_fd, pos, os.SEEK_SET)
+            buf = os.read(src_fd, count)
+            os.lseek(dst_fd, pos, os.SEEK_SET)
+            n = len(buf)
+            while buf:
+                buf = buf[os.write(dst_fd, buf):]
+        if n == 0:
+            break   # the source is shorter than it was
+        pos += n
+    return use_kernel
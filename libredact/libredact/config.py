@@ -21,6 +21,7 @@ def parsehandle(handle):
       'input_file': None,
       'dfxml_file': None,
       'report_file': None,
+      'stream': False,
       'ignore_patterns': []
     }
 
@@ -42,6 +43,18 @@ def parsehandle(handle):
             result['commit'] = True
             continue
 
+        if cmd == "STREAM":
+            result['stream'] = True
+            continue
+
+        if cmd == "PARALLEL_WALK":
+            result['parallel_walk'] = True
+            continue
+
+        if cmd == "ALLOCATED_ONLY":
+            result['allocated_only'] = True
+            continue
+
         if cmd == "INPUT_FILE":
             result['input_file'] = atoms[1]
             continue
@@ -58,6 +71,26 @@ def parsehandle(handle):
             result['dfxml_file'] = atoms[1]
             continue
 
+        if cmd == 'DFXML_CACHE_DIR':
+            result['dfxml_cache_dir'] = atoms[1]
+            continue
+
+        if cmd == 'CACHE_DIR':
+            result['cache_dir'] = atoms[1]
+            continue
+
+        if cmd == 'METRICS_FILE':
+            result['metrics_file'] = atoms[1]
+            continue
+
+        if cmd == 'PROMETHEUS_FILE':
+            result['prometheus_file'] = atoms[1]
+            continue
+
+        if cmd == 'CONTENT_CACHE_MB':
+            result['content_cache_size'] = int(atoms[1]) * 1024 * 1024
+            continue
+
         if cmd == 'IGNORE':
             result['ignore_patterns'].append(atoms[1])
             continue
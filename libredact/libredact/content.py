@@ -0,0 +1,246 @@
+'''Shared file contents
+
+The Redactor gives each fileobject a content_cache while its rules are evaluated, so that the
+file is read from the image once, however many content rules look at it. For raw images the
+contents are read through an image_reader, without the copies fileobject.contents() makes.
+'''
+
+import io
+import logging
+import mmap
+import os
+import sys
+import tempfile
+import dfxml
+from .extract import needs_icat
+
+MAX_MEMORY = 1024 * 1024 * 128   # default cap on the contents held in memory
+CHUNK_SIZE = 1024 * 1024 * 16    # window size when larger files are streamed
+
+# ctypes (and so lightgrep) can only address a memoryview from Python 3 on
+ZERO_COPY = sys.version_info[0] >= 3
+
+
+class image_reader:
+
+    """Reads file contents from a raw image. Where it can, the image is memory-mapped, and a
+    file stored in one piece is returned as a memoryview of the map, with no copy. Other files
+    are read with readinto, run by run, into one preallocated bytearray."""
+
+    def __init__(self, imagefile):
+        self.imagefile = imagefile
+        self.raw = io.FileIO(imagefile.fileno(), 'r', closefd=False)
+        self.map = None
+        self.view = None
+        if ZERO_COPY:
+            try:
+                # ACCESS_COPY is private to this process, and writable so ctypes can address it
+                self.map = mmap.mmap(imagefile.fileno(), 0, access=mmap.ACCESS_COPY)
+                self.view = memoryview(self.map)
+            except (ValueError, EnvironmentError) as e:
+                logging.debug("Cannot map %s, reading it instead (%s)" % (imagefile.name, e))
+
+    def maps(self, fileobject):
+        """True if the contents of FILEOBJECT can be returned without a copy"""
+        runs = fileobject.byte_runs()
+        return self.view is not None and len(runs) > 0 and _contiguous(runs)
+
+    def contents(self, fileobject):
+        """Returns the contents of FILEOBJECT as a memoryview or a bytearray"""
+        runs = fileobject.byte_runs()
+        if self.maps(fileobject):
+            start = runs[0].img_offset
+            return self.view[start:start + sum(run.len for run in runs)]
+        buf = bytearray(sum(max(run.len or 0, 0) for run in runs))
+        self.read_runs(runs, memoryview(buf))
+        return buf
+
+    def read_runs(self, runs, dest):
+        """Reads the bytes of RUNS into the writable buffer DEST, one after another. Fill runs
+        are filled in place; DEST is expected to start out zeroed."""
+        pos = 0
+        for run in runs:
+            count = max(run.len or 0, 0)
+            part = dest[pos:pos + count]
+            pos += count
+            if hasattr(run, 'fill') or run.img_offset is None:
+                fill = getattr(run, 'fill', 0) or 0
+                if fill:
+                    part[:] = bytearray([fill]) * count
+                continue
+            self.raw.seek(run.img_offset)
+            while len(part) > 0:
+                n = self.raw.readinto(part)
+                if not n:
+                    break   # beyond the end of the image
+                part = part[n:]
+
+    def iter_runs(self, fileobject, chunk_size=CHUNK_SIZE):
+        """Yields the contents of FILEOBJECT run by run, as (file offset, buffer) pieces of at
+        most CHUNK_SIZE bytes: memoryviews of the map, or else one bytearray that is read into
+        again for every piece, so a piece is only good until the next one is asked for. A short
+        piece is a memoryview of the start of the bytearray, or a copy where lightgrep cannot
+        address a memoryview (see ZERO_COPY)."""
+        buf = None
+        pos = 0
+        for run in fileobject.byte_runs():
+            count = max(run.len or 0, 0)
+            if hasattr(run, 'fill') or run.img_offset is None:
+                fill = bytearray([getattr(run, 'fill', 0) or 0]) * min(count, chunk_size)
+                for start in range(0, count, chunk_size):
+                    n = min(chunk_size, count - start)
+                    yield (pos + start, fill if n == len(fill) else fill[:n])
+            elif self.view is not None:
+                for start in range(0, count, chunk_size):
+                    offset = run.img_offset + start
+                    piece = self.view[offset:offset + min(chunk_size, count - start)]
+                    if len(piece) > 0:
+                        yield (pos + start, piece)
+            else:
+                if buf is None:
+                    buf = bytearray(chunk_size)
+                    head = memoryview(buf) if ZERO_COPY else buf
+                self.raw.seek(run.img_offset)
+                for start in range(0, count, chunk_size):
+                    n = self.raw.readinto(memoryview(buf)[:min(chunk_size, count - start)])
+                    if not n:
+                        break   # beyond the end of the image
+                    yield (pos + start, buf if n == len(buf) else head[:n])
+            pos += count
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def _contiguous(runs):
+    """True if RUNS lie one after another in the image, with no fill runs"""
+    end = None
+    for run in runs:
+        if hasattr(run, 'fill') or run.img_offset is None or not run.len or run.len < 0:
+            return False
+        if end is not None and run.img_offset != end:
+            return False
+        end = run.img_offset + run.len
+    return True
+
+
+class content_cache:
+
+    """Holds the contents of one fileobject. The contents are read on first use. Files larger than
+    max_memory are streamed instead of held in memory; if SPOOL is set, because more than one
+    rule will read them, the first pass over them also copies them to a temporary file, which
+    the later passes read instead of the image. Contents that only icat can give come from the
+    icat_extractor, if there is one."""
+
+    def __init__(self, fileobject, max_memory=MAX_MEMORY, image=None, extractor=None,
+                 spool=False):
+        self.fileobject = fileobject
+        self.max_memory = max_memory
+        self.image = image
+        self.extractor = extractor
+        self.spool = spool
+        self._data = None
+        self._tempfile = None
+        self._spooled = None   # temporary file holding all of the contents, once they streamed
+        self.bytes_read = 0    # bytes of contents loaded, for the metrics
+
+    def contents(self):
+        """Returns the contents of the file, as bytes, a bytearray, a memoryview of the image or
+        a private mmap"""
+        if self._data is None:
+            if self._extracted():
+                self._data = self._read_extracted()
+            elif self.image is not None and self._raw():
+                self._data = self.image.contents(self.fileobject)
+            else:
+                self._data = self.fileobject.contents()
+            self.bytes_read += len(self._data)
+        return self._data
+
+    def iter_contents(self, chunk_size=CHUNK_SIZE, overlap=0):
+        """Yields the contents of the file as (file offset, buffer) windows. Contents that are
+        held already, or that fit in max_memory, or that map without a copy, come in a single
+        window that the rules share. Larger files are streamed, so memory use does not grow
+        with the file: with no OVERLAP, straight from the image run by run (see
+        image_reader.iter_runs), and otherwise with fileobject.iter_contents."""
+        if self._data is not None or (self.fileobject.filesize() or 0) <= self.max_memory or \
+                (self.image is not None and self._raw() and self.image.maps(self.fileobject)):
+            yield (0, self.contents())
+            return
+        if self._spooled is not None:
+            spooled = self._spooled
+            spooled.seek(0)
+            for window in dfxml.content_windows(iter(lambda: spooled.read(chunk_size), b''),
+                                                chunk_size, overlap):
+                yield window
+            return
+        f = None
+        spool = None
+        if self._extracted():
+            f = self.extractor.extract(self.fileobject)
+            windows = dfxml.content_windows(iter(lambda: f.read(chunk_size), b''), chunk_size,
+                                            overlap)
+        elif overlap == 0 and self.image is not None and self._raw():
+            windows = self.image.iter_runs(self.fileobject, chunk_size)
+        else:
+            windows = self.fileobject.iter_contents(chunk_size, overlap)
+        if self.spool and f is None:
+            spool = tempfile.TemporaryFile()   # icat output is on disk already
+        complete = False
+        try:
+            end = 0
+            for (offset, window) in windows:
+                start = max(end, offset)   # the bytes before were in the last window
+                self.bytes_read += offset + len(window) - start
+                if spool is not None:
+                    spool.seek(start)
+                    spool.write(window[start - offset:])
+                end = offset + len(window)
+                yield (offset, window)
+            complete = True
+        finally:
+            if f is not None:
+                f.close()
+            if spool is not None:
+                if complete:
+                    spool.truncate(end)
+                    self._spooled = spool
+                else:
+                    spool.close()   # a rule stopped early, so no other one reads the file
+
+    def _extracted(self):
+        """True if the contents come from icat, through the extractor"""
+        return self.extractor is not None and needs_icat(self.fileobject)
+
+    def _read_extracted(self):
+        f = self.extractor.extract(self.fileobject)
+        if os.fstat(f.fileno()).st_size <= self.max_memory:
+            with f:
+                return f.read()
+        self._tempfile = f
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def _raw(self):
+        """True if the runs can be read straight from the image (fileobject.contents() refuses
+        encrypted files, and uses icat for compressed files and for AFF and E01 images)"""
+        name = self.fileobject.imagefile.name
+        return not (self.fileobject.compressed() or self.fileobject.encrypted() or
+                    name.endswith(".aff") or name.endswith(".E01"))
+
+    def close(self):
+        """Drops the contents, before the next file is evaluated"""
+        if isinstance(self._data, memoryview):
+            self._data.release()   # the image map cannot be closed while it is exported
+        if self._tempfile is not None:
+            self._data.close()
+            self._tempfile.close()
+            self._tempfile = None
+        if self._spooled is not None:
+            self._spooled.close()
+            self._spooled = None
+        self._data = None
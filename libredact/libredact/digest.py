@@ -0,0 +1,156 @@
+'''On-demand file hashing
+
+DFXML made with fiwalk -z, or by tools that do not hash, has no MD5 or SHA1 digests, and the
+FILE_MD5 and FILE_SHA1 rules then never match. A digest_pool computes the digests the rules need
+for the files that lack them, reading their byte runs from the image in worker threads (hashlib
+releases the GIL while it hashes), and keeps them beside the DFXML cache so that later runs over
+the same image do not hash the files again.
+'''
+
+import hashlib
+import logging
+import os
+import threading
+import fiwalk
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue   # Python 2
+
+WORKERS = 4                        # files hashed at the same time
+CHUNK_SIZE = 1024 * 1024           # bytes read from the image at a time
+
+
+class digest_pool:
+
+    """Hashes the files of IMAGE_PATH with ALGORITHMS (names of hashlib algorithms). If SIZES is
+    not None, only files of those sizes are hashed: the rules cannot match the others. Digests
+    are kept in CACHE_PATH if it is given."""
+
+    def __init__(self, image_path, algorithms, sizes=None, cache_path=None, workers=WORKERS):
+        self.image_path = image_path
+        self.algorithms = tuple(algorithms)
+        self.sizes = sizes
+        self.cache_path = cache_path
+        self.digests = {}   # key: {algorithm: hex digest}
+        self.hashed = 0     # bytes hashed
+        self.lock = threading.Lock()
+        self.memo = None
+        if cache_path is not None:
+            self._load()
+            self.memo = open(cache_path, 'a')
+        self.local = threading.local()
+        self.queue = Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 3 and len(fields[2]) > 0:   # the last line may be cut short
+                    self.digests.setdefault(fields[0], {})[fields[1]] = fields[2]
+
+    @staticmethod
+    def key(fileobject):
+        """Identifies the file in the image by its name, inode, size and byte runs"""
+        runs = ','.join('%s+%s' % (run.img_offset, run.len) for run in fileobject.byte_runs())
+        text = '%s\t%s\t%s\t%s' % (fileobject.filename(), fileobject.inode(),
+                                   fileobject.filesize(), runs)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def missing(self, fileobject):
+        """Returns the algorithms whose digests FILEOBJECT lacks and needs"""
+        if fileobject.encrypted() or (self.sizes is not None and
+                                      fileobject.filesize() not in self.sizes):
+            return ()
+        return tuple(alg for alg in self.algorithms if not fileobject.tag(alg))
+
+    def submit(self, fileobject):
+        """Starts hashing FILEOBJECT if it lacks a digest the rules need. Digests found in the
+        cache are set at once."""
+        algorithms = self.missing(fileobject)
+        if not algorithms:
+            return
+        key = self.key(fileobject)
+        known = self.digests.get(key, {})
+        if all(alg in known for alg in algorithms):
+            _set_digests(fileobject, known)
+            return
+        job = fileobject.digest_job = [threading.Event(), key, None]
+        self.queue.put((fileobject, algorithms, job))
+
+    def wait(self, fileobject):
+        """Waits until the digests of FILEOBJECT are set, if it was submitted"""
+        job = fileobject.__dict__.pop('digest_job', None)
+        if job is None:
+            return
+        job[0].wait()
+        if job[2] is not None:
+            logging.warning("Cannot hash %s: %s" % (fileobject.filename(), job[2]))
+            return
+        _set_digests(fileobject, self.digests[job[1]])
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                if getattr(self.local, 'imagefile', None) is not None:
+                    self.local.imagefile.close()
+                return
+            (fileobject, algorithms, job) = item
+            try:
+                self._hash(fileobject, algorithms, job[1])
+            except Exception as e:
+                job[2] = str(e)
+            job[0].set()
+
+    def _hash(self, fileobject, algorithms, key):
+        imagefile = getattr(self.local, 'imagefile', None)
+        if imagefile is None:
+            imagefile = self.local.imagefile = open(self.image_path, 'rb')
+        hashes = [hashlib.new(alg) for alg in algorithms]
+        size = 0
+        for (offset, buf) in fileobject.iter_contents(CHUNK_SIZE, imagefile=imagefile):
+            for h in hashes:
+                h.update(buf)
+            size += len(buf)
+        with self.lock:
+            self.hashed += size
+            known = self.digests.setdefault(key, {})
+            for (alg, h) in zip(algorithms, hashes):
+                known[alg] = h.hexdigest()
+                if self.memo is not None:
+                    self.memo.write('%s\t%s\t%s\n' % (key, alg, known[alg]))
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.memo is not None:
+            self.memo.close()
+            self.memo = None
+        logging.debug("Hashed %d bytes on demand" % self.hashed)
+
+
+def _set_digests(fileobject, digests):
+    for (alg, value) in digests.items():
+        fileobject._tags[alg] = value
+        fileobject.hashdigest[alg] = value
+
+
+def digest_cache_path(cache_dir, imagefile):
+    """Returns the path of the file that keeps the digests computed for IMAGEFILE in CACHE_DIR,
+    the DFXML cache directory"""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.splitext(fiwalk.dfxml_cache_path(cache_dir, imagefile, 'digests'))[0] + \
+        '.digests'
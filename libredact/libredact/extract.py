@@ -0,0 +1,239 @@
+'''Pooled icat extraction
+
+Compressed files, and every file of an AFF or E01 image, cannot be read straight from the image,
+so fileobject.contents() runs icat for each of them and holds all of its output. An icat_extractor
+runs a few icat processes at a time from worker threads, writes their output straight to a
+bounded on-disk cache keyed by image and inode, and lets the Redactor start extracting files
+before their rules need them. Only one process extracts and evicts: forked worker processes get a
+reader, and open the files pinned for them.
+'''
+
+import copy
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from subprocess import Popen
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue   # Python 2
+
+WORKERS = 4                        # icat processes run at the same time
+MAX_CACHE = 1024 * 1024 * 1024     # bytes of extracted contents kept on disk
+
+
+def needs_icat(fileobject):
+    """True if the contents of FILEOBJECT can only be had from icat"""
+    name = fileobject.imagefile.name
+    return not fileobject.encrypted() and \
+        (fileobject.compressed() or name.endswith('.aff') or name.endswith('.E01'))
+
+
+class icat_extractor:
+
+    """Extracts file contents with icat into DIRECTORY (a private temporary directory if None),
+    which is kept under MAX_CACHE bytes by removing the least recently used files. The files of
+    a directory given by the caller are reused by later runs over the same image."""
+
+    def __init__(self, image_path, directory=None, max_cache=MAX_CACHE, workers=WORKERS,
+                 icat='icat'):
+        self.image_path = image_path
+        self.private = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='libredact-icat-')
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_cache = max_cache
+        self.workers = workers
+        self.icat = icat
+        st = os.stat(image_path)
+        self.image_key = '%s\t%d\t%d' % (os.path.abspath(image_path), st.st_size,
+                                         int(st.st_mtime))
+        self.lock = threading.Lock()
+        self.jobs = {}                  # key: [done event, error] of extractions under way
+        self.entries = OrderedDict()    # key: size of the cached files, least recently used first
+        self.pinned = {}                # key: number of pins of files a worker process reads
+        self.size = 0
+        self.extracts = True            # False in the readers of worker processes
+        self._scan()
+        self.queue = Queue()
+        self.threads = []   # started with the first extraction, so a pool can fork before it
+
+    def _scan(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.data'):
+                st = os.stat(os.path.join(self.directory, name))
+                found.append((st.st_mtime, name[:-5], st.st_size))
+        for (mtime, key, size) in sorted(found):
+            self.entries[key] = size
+            self.size += size
+
+    def key(self, fileobject):
+        volume = getattr(fileobject, 'volume', None)
+        text = '%s\t%s\t%s' % (self.image_key, getattr(volume, 'offset', 0), fileobject.inode())
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.data')
+
+    def _submit(self, fileobject):
+        """Queues the extraction of FILEOBJECT unless it is cached or under way. Returns the key
+        and the job, which is None if the contents are cached."""
+        cmd = [self.icat] + fileobject.icat_command()[1:]
+        key = self.key(fileobject)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None or key in self.entries:
+                return (key, job)
+            job = self.jobs[key] = [threading.Event(), None]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.queue.put((key, cmd, job))
+        return (key, job)
+
+    def _wait(self, fileobject):
+        """Extracts FILEOBJECT unless it is cached, and returns its key once it is. Raises
+        ValueError if icat fails."""
+        (key, job) = self._submit(fileobject)
+        if job is not None:
+            job[0].wait()
+            with self.lock:
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
+            if job[1] is not None:
+                raise ValueError(job[1])
+        return key
+
+    def _touch(self, key):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.entries[key] = size   # most recently used
+
+    def prefetch(self, fileobject):
+        """Starts extracting FILEOBJECT in the background"""
+        try:
+            self._submit(fileobject)
+        except ValueError:
+            pass   # extract() reports it
+
+    def extract(self, fileobject):
+        """Returns the contents of FILEOBJECT as an open file, waiting for icat if they are not
+        cached. Raises ValueError if icat fails."""
+        if not self.extracts:
+            try:
+                return open(self.path(self.key(fileobject)), 'rb')
+            except IOError:
+                raise ValueError("The contents of %s were not extracted for this worker" %
+                                 fileobject.filename())
+        for attempt in range(2):
+            key = self._wait(fileobject)
+            with self.lock:
+                try:
+                    f = open(self.path(key), 'rb')
+                except IOError:
+                    continue   # removed to make room before it could be read
+                self._touch(key)
+                return f
+        raise ValueError("Cannot keep the contents of %s in %s" %
+                         (fileobject.filename(), self.directory))
+
+    def pin(self, fileobject):
+        """Extracts FILEOBJECT, waiting for icat, and keeps it in the cache until unpin(), for a
+        worker process to read. Raises ValueError if icat fails."""
+        for attempt in range(2):
+            key = self._wait(fileobject)
+            with self.lock:
+                if key in self.entries:
+                    self._touch(key)
+                    self.pinned[key] = self.pinned.get(key, 0) + 1
+                    return
+        raise ValueError("Cannot keep the contents of %s in %s" %
+                         (fileobject.filename(), self.directory))
+
+    def unpin(self, fileobject):
+        key = self.key(fileobject)
+        with self.lock:
+            if self.pinned[key] > 1:
+                self.pinned[key] -= 1
+            else:
+                del self.pinned[key]
+                self._evict()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (key, cmd, job) = item
+            try:
+                job[1] = self._run(key, cmd)
+            except Exception as e:
+                job[1] = "icat failed (%s): %s" % (e, " ".join(cmd))
+            job[0].set()
+
+    def _run(self, key, cmd):
+        """Runs icat with its output going to the cache. Returns an error message, or None."""
+        path = self.path(key)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        err = tempfile.TemporaryFile()
+        try:
+            with open(tmp, 'wb') as out:
+                status = Popen(cmd, stdout=out, stderr=err).wait()
+            err.seek(0)
+            message = err.read().decode('utf-8', 'replace').strip()
+        finally:
+            err.close()
+        if status != 0 or len(message) > 0:
+            os.remove(tmp)
+            return "icat error (%s): %s" % (message, " ".join(cmd))
+        size = os.path.getsize(tmp)
+        with self.lock:
+            os.rename(tmp, path)
+            self.size += size - (self.entries.pop(key, None) or 0)
+            self.entries[key] = size
+            self._evict()
+        return None
+
+    def _evict(self):
+        """Removes the least recently used files until the cache fits, keeping the newest and the
+        pinned ones"""
+        for key in list(self.entries)[:-1]:
+            if self.size <= self.max_cache:
+                break
+            if key in self.pinned:
+                continue
+            self.size -= self.entries.pop(key)
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def reader(self):
+        """Returns the extractor of a forked worker process. It only opens the files that this
+        extractor pinned for it, so the cache keeps to its bound and no file is removed while a
+        worker reads it."""
+        reader = copy.copy(self)
+        reader.lock = threading.Lock()
+        reader.threads = []
+        reader.extracts = False
+        reader.private = False
+        return reader
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.private:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        logging.debug("icat cache holds %d files, %d bytes" % (len(self.entries), self.size))
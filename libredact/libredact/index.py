@@ -0,0 +1,64 @@
+'''Indexed rule matching
+
+Finds the rules that apply to a fileobject without testing every metadata rule in turn, so that
+configurations with many thousands of FILE_MD5 or FILE_NAME_EQUAL lines stay fast.
+'''
+
+import posixpath
+from .rule import rule_file_md5, rule_file_sha1, rule_file_name_equal, rule_file_dirname_equal
+
+
+class rule_index:
+
+    """An index over a list of (rule, action) pairs. Rules that compare the MD5, SHA1, file name or
+    directory name for equality are kept in dicts keyed by the value they compare, and the file
+    sizes that MD5 and SHA1 rules may carry are checked on lookup. All other rules are tested in
+    turn. Rules are identified by their position in the list, so that the report can still name
+    the configuration line that fired."""
+
+    def __init__(self, rules):
+        self.md5 = {}
+        self.sha1 = {}
+        self.basename = {}
+        self.dirname = {}
+        self.sizes = {}        # position: file size, of the hash rules that carry one
+        self.indexed = set()   # positions of the rules held in the dicts
+        self.scanned = []      # positions of the rules that must be tested
+        for priority, (rule, action) in enumerate(rules):
+            if rule.__class__ in (rule_file_md5, rule_file_sha1) and rule.size is not None:
+                self.sizes[priority] = rule.size
+            if rule.__class__ == rule_file_md5:
+                self.md5.setdefault(rule.md5val, []).append(priority)
+            elif rule.__class__ == rule_file_sha1:
+                self.sha1.setdefault(rule.sha1val, []).append(priority)
+            elif rule.__class__ == rule_file_name_equal:
+                self.basename.setdefault(rule.filename, []).append(priority)
+            elif rule.__class__ == rule_file_dirname_equal:
+                self.dirname.setdefault(rule.dirname, []).append(priority)
+            else:
+                self.scanned.append(priority)
+                continue
+            self.indexed.add(priority)
+
+    def candidates(self, fi):
+        """Returns, in configuration order, the positions of the indexed rules that match FI and
+        of all the rules that must still be tested against it."""
+        found = []
+        if self.md5:
+            found.extend(self._sized(self.md5.get(fi.tag('md5'), ()), fi))
+        if self.sha1:
+            found.extend(self._sized(self.sha1.get(fi.tag('sha1'), ()), fi))
+        if self.basename or self.dirname:
+            # Force Unix filename conventions, once per file
+            dirname, basename = posixpath.split(fi.filename())
+            found.extend(self.basename.get(basename, ()))
+            found.extend(self.dirname.get(dirname, ()))
+        if not found:
+            return self.scanned
+        return sorted(found + self.scanned)
+
+    def _sized(self, positions, fi):
+        if not self.sizes:
+            return positions
+        size = fi.filesize()
+        return [p for p in positions if self.sizes.get(p, size) == size]
@@ -0,0 +1,151 @@
+'''Performance metrics for redaction runs
+
+The Redactor counts, for each phase of a run and for each rule, the time spent, the bytes read,
+the files handled and the bytes selected for redaction. The counts can be written as JSON or as a
+file for the Prometheus node exporter's textfile collector.
+'''
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+timer = getattr(time, 'perf_counter', time.time)
+
+PHASES = ['copy', 'dfxml', 'evaluate', 'write']
+
+
+def _throughput(count, seconds):
+    if seconds <= 0:
+        return 0.0
+    return count / seconds
+
+
+class redaction_metrics:
+
+    """The metrics of one run. Phase times are exclusive: while a nested phase runs (rules are
+    evaluated while the DFXML is read), its time is not charged to the outer phase. With worker
+    processes, rule times are summed over the workers."""
+
+    def __init__(self):
+        self.phases = dict((name, {'seconds': 0.0, 'bytes': 0, 'files': 0}) for name in PHASES)
+        self.rules = {}     # position in the configuration: rule stats
+        self._stack = []    # names of the phases under way, innermost last
+        self._mark = None
+
+    def _charge(self):
+        now = timer()
+        if self._stack:
+            self.phases[self._stack[-1]]['seconds'] += now - self._mark
+        self._mark = now
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block as phase NAME"""
+        self._charge()
+        self._stack.append(name)
+        try:
+            yield self.phases[name]
+        finally:
+            self._charge()
+            self._stack.pop()
+
+    def count(self, name, files=0, size=0):
+        """Adds FILES files and SIZE bytes to phase NAME"""
+        self.phases[name]['files'] += files
+        self.phases[name]['bytes'] += size
+
+    def rule(self, priority, seconds, bytes_read, runs):
+        """Adds one evaluation of the rule at PRIORITY, which selected RUNS (None if it did not
+        match the file)"""
+        stats = self.rules.get(priority)
+        if stats is None:
+            stats = self.rules[priority] = {'seconds': 0.0, 'files': 0, 'bytes_read': 0,
+                                            'matches': 0, 'runs': 0, 'bytes_redacted': 0}
+        stats['seconds'] += seconds
+        stats['files'] += 1
+        stats['bytes_read'] += bytes_read
+        if runs is not None:
+            stats['matches'] += 1
+            stats['runs'] += len(runs)
+            stats['bytes_redacted'] += sum(run.len for run in runs if run.len)
+
+    def take_rules(self):
+        """Returns the rule stats and starts counting afresh (used by worker processes)"""
+        rules = self.rules
+        self.rules = {}
+        return rules
+
+    def merge_rules(self, rules):
+        for (priority, stats) in rules.items():
+            mine = self.rules.setdefault(priority, dict((k, 0) for k in stats))
+            for (k, v) in stats.items():
+                mine[k] += v
+
+    def as_dict(self, rules=None):
+        """Returns the metrics as a dict. RULES, the configured (rule, action) pairs, names the
+        rules by their configuration line."""
+        ret = {'phases': {}, 'rules': []}
+        for name in PHASES:
+            stats = dict(self.phases[name])
+            if name == 'evaluate':
+                # the rules read the file contents
+                stats['bytes'] += sum(rule['bytes_read'] for rule in self.rules.values())
+            stats['bytes_per_second'] = _throughput(stats['bytes'], stats['seconds'])
+            stats['files_per_second'] = _throughput(stats['files'], stats['seconds'])
+            ret['phases'][name] = stats
+        ret['seconds'] = sum(self.phases[name]['seconds'] for name in PHASES)
+        for priority in sorted(self.rules):
+            stats = dict(self.rules[priority])
+            stats['priority'] = priority
+            if rules is not None:
+                stats['rule'] = str(rules[priority][0])
+            stats['bytes_per_second'] = _throughput(stats['bytes_read'], stats['seconds'])
+            stats['files_per_second'] = _throughput(stats['files'], stats['seconds'])
+            ret['rules'].append(stats)
+        return ret
+
+    def write_json(self, path, rules=None):
+        _write_atomic(path, json.dumps(self.as_dict(rules), indent=4, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path, rules=None):
+        """Writes the metrics in the Prometheus text format. The textfile collector reads files
+        ending in .prom, so the file is replaced atomically."""
+        data = self.as_dict(rules)
+        lines = []
+
+        def gauge(name, text, samples):
+            lines.append('# HELP libredact_%s %s' % (name, text))
+            lines.append('# TYPE libredact_%s gauge' % name)
+            for (labels, value) in samples:
+                labels = ','.join('%s="%s"' % (k, _escape(v)) for (k, v) in labels)
+                lines.append('libredact_%s{%s} %s' % (name, labels, repr(float(value))))
+
+        for (key, text) in [('seconds', 'Time spent in the phase'),
+                            ('bytes', 'Bytes handled in the phase'),
+                            ('files', 'Files handled in the phase'),
+                            ('bytes_per_second', 'Bytes per second in the phase'),
+                            ('files_per_second', 'Files per second in the phase')]:
+            gauge('phase_' + key, text,
+                  [([('phase', name)], data['phases'][name][key]) for name in PHASES])
+        for (key, text) in [('seconds', 'Time spent evaluating the rule'),
+                            ('files', 'Files the rule was evaluated on'),
+                            ('bytes_read', 'Bytes of file contents read for the rule'),
+                            ('matches', 'Files the rule matched'),
+                            ('runs', 'Byte runs the rule selected'),
+                            ('bytes_redacted', 'Bytes the rule selected for redaction')]:
+            gauge('rule_' + key, text,
+                  [([('priority', str(stats['priority'])), ('rule', stats.get('rule', ''))],
+                    stats[key]) for stats in data['rules']])
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.rename(tmp, path)
@@ -0,0 +1,131 @@
+'''Redaction plans
+
+A redaction plan gathers the image extents selected by the rules while the DFXML is walked, then
+writes them in a single pass over the image, in image offset order.
+'''
+
+import heapq
+import logging
+
+
+class redaction_plan:
+
+    """Collects the extents to redact and applies them in image offset order. Where extents
+    overlap, each byte is written once, by the extent added with the lowest priority value
+    (the Redactor uses the position of the rule in the configuration)."""
+
+    chunk_size = 1024 * 1024 * 8   # largest single write made by apply()
+
+    def __init__(self):
+        self.extents = []   # (img_offset, end, priority, sequence, action)
+
+    def __len__(self):
+        return len(self.extents)
+
+    def add(self, img_offset, length, action, priority=0):
+        """Adds LENGTH bytes at IMG_OFFSET to the plan, to be redacted by ACTION."""
+        if length <= 0:
+            return
+        self.extents.append((img_offset, img_offset + length, priority, len(self.extents),
+                             action))
+
+    def segments(self):
+        """Returns the plan as a list of non-overlapping (start, end, action) tuples, sorted by
+        image offset. Adjacent segments with the same action are merged."""
+        extents = sorted(self.extents)
+        ret = []
+        active = []   # heap of (priority, sequence, end, action) covering pos
+        i = 0
+        pos = None
+        while i < len(extents) or active:
+            if not active:
+                pos = extents[i][0]
+            while i < len(extents) and extents[i][0] <= pos:
+                start, end, priority, seq, action = extents[i]
+                heapq.heappush(active, (priority, seq, end, action))
+                i += 1
+            while active and active[0][2] <= pos:
+                heapq.heappop(active)   # finished extents are dropped lazily
+            if not active:
+                continue
+            priority, seq, end, action = active[0]
+            if i < len(extents) and extents[i][0] < end:
+                end = extents[i][0]
+            if ret and ret[-1][1] == pos and ret[-1][2] is action:
+                ret[-1] = (ret[-1][0], end, action)
+            else:
+                ret.append((pos, end, action))
+            pos = end
+        return ret
+
+    def redacted_bytes(self):
+        """Returns the number of image bytes the plan will overwrite."""
+        return sum(end - start for (start, end, action) in self.segments())
+
+    def apply(self, imagefile, source=None, start=0, progress=None):
+        """Writes every segment of the plan into IMAGEFILE, in image offset order. Actions that
+        read the original bytes read them from SOURCE if given, which makes a repeated apply give
+        the same result. Segments before image offset START are skipped, and PROGRESS, if given, is
+        called with the image offset reached after each segment."""
+        segments = self.segments()
+        logging.debug("Applying %d redaction segments" % len(segments))
+        pos = None
+        for (offset, end, action) in segments:
+            if end <= start:
+                continue
+            offset = max(offset, start)
+            while offset < end:
+                count = min(end - offset, self.chunk_size)
+                if pos != offset:
+                    imagefile.seek(offset)
+                original = None
+                if action.reads_image and source is not None:
+                    source.seek(offset)
+                    original = source.read(count)
+                elif action.reads_image:
+                    original = imagefile.read(count)
+                    imagefile.seek(offset)
+                imagefile.write(action.redacted_bytes(count, original))
+                offset += count
+                pos = offset
+            if progress is not None:
+                progress(end)
+
+    def stream(self, source, dest, chunk_size=None):
+        """Copies SOURCE to DEST in a single pass, replacing the planned segments as they stream
+        past. DEST only needs a write method, so it may be a pipe or standard output."""
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        segments = self.segments()
+        si = 0
+        offset = 0
+        while True:
+            buf = source.read(chunk_size)
+            if not buf:
+                break
+            end = offset + len(buf)
+            if si == len(segments) or segments[si][0] >= end:
+                dest.write(buf)   # nothing to redact in this chunk
+                offset = end
+                continue
+            parts = []
+            pos = offset
+            while si < len(segments) and segments[si][0] < end:
+                start, stop, action = segments[si]
+                start = max(start, pos)
+                clip = min(stop, end)
+                parts.append(buf[pos - offset:start - offset])
+                original = None
+                if action.reads_image:
+                    original = buf[start - offset:clip - offset]
+                parts.append(action.redacted_bytes(clip - start, original))
+                pos = clip
+                if stop > end:
+                    break   # segment continues into the next chunk
+                si += 1
+            parts.append(buf[pos - offset:])
+            dest.write(b"".join(parts))
+            offset = end
+        if si < len(segments):
+            logging.warning("%d redaction segments lie beyond the end of the image" %
+                            (len(segments) - si))
@@ -4,15 +4,38 @@ Redacts disk images according to the given configuration.
 '''
 
 import logging
+import os
 import fiwalk
+import dfxml
 import re
-import shutil
-from .rule import redact_rule, rule_file_md5, rule_file_sha1, convert_fileglob_to_re
+import copy
+from .rule import redact_rule, rule_file_md5, rule_file_sha1, convert_fileglob_to_re, \
+    compile_lightgrep_rules
 from .action import redact_action, _
+from .plan import redaction_plan
+from .clone import clone_file
+from .content import content_cache, image_reader, MAX_MEMORY
+from .index import rule_index
+from .checkpoint import checkpoint
+from .cache import redaction_cache
+from .metrics import redaction_metrics, timer, PHASES
+from .volumes import walk_volumes
+from .extract import icat_extractor, needs_icat
+from .digest import digest_pool, digest_cache_path
+from collections import deque
 
 
 first = True
 
+# The fileobject tags the Redactor itself uses, and those needed to read file contents
+BASE_TAGS = ('filename', 'name_type', 'filesize', 'meta_type')
+CONTENT_TAGS = ('compressed', 'encrypted', 'inode')
+
+LOOKAHEAD = 8   # files evaluated behind the walk while icat and hashing run ahead
+POOL_WINDOW = 4     # files per worker gathered from the walk, then handed out largest first
+                    # (within that window only, a large file late in the walk still comes late)
+POOL_INFLIGHT = 16  # files per worker in flight before the walk waits for results
+
 
 class Redactor:
     conf = None
@@ -25,14 +48,18 @@ class Redactor:
     progress_callback = None
 
     def __init__(self, input_file=None, output_file=None, dfxml_file=None, report_file=None,
-                 commit=False, ignore_patterns=[], rules=[]):
+                 commit=False, ignore_patterns=[], rules=[], stream=False, jobs=1,
+                 content_cache_size=MAX_MEMORY, resume=False,
+                 cache_dir=None, metrics_file=None, prometheus_file=None, dfxml_cache_dir=None,
+                 parallel_walk=False, allocated_only=False):
         #  Validate configuration
         from schema import Schema, Optional, Or, Use, And, SchemaError
         schema = Schema({
             'input_file': Use(lambda f: open(f, 'r'), error='Cannot read the input file'),
             Optional('output_file'):
-            Or(None,
-               Use(lambda f: open(f, 'w'), error='Cannot write to the output file')),
+            Or(None, '-',
+               Use(lambda f: open(f, 'a' if resume else 'w'),
+                   error='Cannot write to the output file')),
             Optional('dfxml_file'):
             Or(None,
                Use(lambda f: open(f, 'rb'), error='Cannot read DFXML file')),
@@ -40,6 +67,17 @@ class Redactor:
             Or(None,
                lambda f: open(f, 'w'), error='Cannot write to the report file'),
             'commit': Or(True, False),
+            'stream': Or(True, False),
+            'resume': Or(True, False),
+            'parallel_walk': Or(True, False),
+            'allocated_only': Or(True, False),
+            'cache_dir': Or(None, Use(str)),
+            'dfxml_cache_dir': Or(None, Use(str)),
+            'metrics_file': Or(None, Use(str)),
+            'prometheus_file': Or(None, Use(str)),
+            'jobs': And(int, lambda n: n > 0, error='Jobs must be a positive number'),
+            'content_cache_size': And(int, lambda n: n >= 0,
+                                      error='Content cache size must be a number of bytes'),
             'ignore_patterns':
                 Use(lambda f: re.compile(convert_fileglob_to_re('|'.join(f))),
                     error='Cannot compile unified ignore regex'),
@@ -51,6 +89,16 @@ class Redactor:
             'dfxml_file': dfxml_file,
             'report_file': report_file,
             'commit': commit,
+            'stream': stream,
+            'resume': resume,
+            'parallel_walk': parallel_walk,
+            'allocated_only': allocated_only,
+            'cache_dir': cache_dir,
+            'dfxml_cache_dir': dfxml_cache_dir,
+            'metrics_file': metrics_file,
+            'prometheus_file': prometheus_file,
+            'jobs': jobs,
+            'content_cache_size': content_cache_size,
             'ignore_patterns': ignore_patterns,
             'rules': rules
         }
@@ -62,14 +110,43 @@ class Redactor:
         if self.conf['commit'] and 'output_file' not in self.conf.keys():
             logging.error('An output file is required when COMMIT is on.')
             exit(1)
+        if self.conf['output_file'] == '-' and not self.conf['stream']:
+            logging.error('Writing the output to standard output requires STREAM.')
+            exit(1)
 
         self.input_file = self.conf['input_file']
-        from os import path
-        self.image_size = path.getsize(self.input_file.name)
+        self.image_size = os.path.getsize(self.input_file.name)
         self.output_file = self.conf['output_file']
         self.report_file = self.conf['report_file']
         self.dfxml_file = self.conf['dfxml_file']
         self.commit = self.conf['commit']
+        self.stream = self.conf['stream']
+        self.jobs = self.conf['jobs']
+        self.content_cache_size = self.conf['content_cache_size']
+        self.resume = self.conf['resume']
+        self.parallel_walk = self.conf['parallel_walk']
+        self.allocated_only = self.conf['allocated_only']
+        self.files_walked = 0
+        self.resume_files = 0
+        self.cache_dir = self.conf['cache_dir']
+        self.dfxml_cache_dir = self.conf['dfxml_cache_dir'] or self.cache_dir
+        self.cache = None
+        self.image_reader = None
+        self.extractor = None
+        self.hasher = None
+        self.lookahead = deque()   # (fileobject, walk position) waiting for icat or hashing
+        self.pool = None
+        self.window = []           # (fileobject, walk position, prefetched) not yet handed out
+        self.inflight = deque()    # [fileobject, walk position, result, pinned] in walk order
+        self.metrics = redaction_metrics()
+        self.checkpoint = None
+        if self.commit and self.output_file not in (None, '-'):
+            self.checkpoint = checkpoint(self.output_file.name + '.checkpoint',
+                                         checkpoint.hash_config(self.conf))
+        self.plan = redaction_plan()
+        self.index = rule_index(self.conf['rules'])
+        # One lightgrep program for all of the SEQ rules, so each file is searched once
+        compile_lightgrep_rules([rule for (rule, action) in self.conf['rules']])
         self.configure_report_logger()
 
     def need_md5(self):
@@ -84,14 +161,54 @@ class Redactor:
                 return True
         return False
 
+    def hash_rules(self):
+        """Returns the hash algorithms that the rules compare, and the file sizes that they carry,
+        or None for the sizes if some rule does not carry one"""
+        algorithms = set()
+        sizes = set()
+        for (rule, action) in self.conf['rules']:
+            if rule.__class__ in (rule_file_md5, rule_file_sha1):
+                algorithms.add('md5' if rule.__class__ == rule_file_md5 else 'sha1')
+                if rule.size is None:
+                    sizes = None
+                elif sizes is not None:
+                    sizes.add(rule.size)
+        return (algorithms, sizes)
+
+    def needed_tags(self):
+        """Returns the set of fileobject tags that the configured rules need. The DFXML reader
+        drops all other tags."""
+        tags = set(BASE_TAGS)
+        if self.allocated_only:
+            tags.update(('alloc', 'ALLOC'))
+        for (rule, action) in self.conf['rules']:
+            tags.update(rule.tags)
+            if rule.reads_contents or rule.__class__ in (rule_file_md5, rule_file_sha1):
+                tags.update(CONTENT_TAGS)
+        return tags
+
     def fiwalk_opts(self):
-        "Returns the options that fiwalk needs given the redaction requested."
-        opts = "-x"
-        if self.need_sha1():
-            opts = opts + "1"
-        if self.need_md5():
-            opts = opts + "m"
-        return opts
+        """Returns the options that fiwalk needs given the redaction requested, besides -x.
+        fiwalk computes both hashes of every file unless told otherwise, which is often most of
+        its run time, so hashing is turned off (-z) and turned back on only for the hashes the
+        rules compare (-M, -1). When every hash rule carries a file size, the few files of those
+        sizes are hashed on demand instead. A walk kept in the redaction cache must serve later
+        configurations, so it is made with the defaults."""
+        if self.cache is not None and not self.cache.walked:
+            return ""
+        (algorithms, sizes) = self.hash_rules()
+        if sizes is not None:
+            algorithms = ()
+        opts = ""
+        if not ('md5' in algorithms and 'sha1' in algorithms):
+            opts += "z"
+            if 'md5' in algorithms:
+                opts += "M"
+            if 'sha1' in algorithms:
+                opts += "1"
+        if self.allocated_only:
+            opts += "O"
+        return "-" + opts if opts else ""
 
     def should_ignore(self, fi):
         if len(self.conf['ignore_patterns'].pattern) == 0:
@@ -104,34 +221,207 @@ class Redactor:
             percent = int(100 * self.bytes_processed / self.image_size)
             self.progress_callback.updateProgressBar(percent)
             self.bytes_processed = self.bytes_processed + fileinfo.filesize()
+        self.files_walked += 1
+        if self.cache is not None and not self.cache.walked:
+            self.cache.add(fileinfo)
+        if self.files_walked <= self.resume_files:
+            return  # recorded before the checkpoint
+        if self.checkpoint is not None and self.pool is None and self.extractor is None and \
+                self.hasher is None:
+            self.checkpoint.update(files=self.files_walked - 1)
         if fileinfo.is_dir() or fileinfo.filename().startswith('$'):
             logging.debug("Ignoring folder or system file: %s" % fileinfo.filename())
             return
         if self.should_ignore(fileinfo):
             logging.info("Ignoring %s" % fileinfo.filename())
             return
+        if self.allocated_only and not fileinfo.allocated():
+            return   # a walk from a DFXML file or a cache may hold deleted files
 
         if fileinfo.filename().startswith('.goutputstream'):
             logging.debug('got a .goutputstream file in meta_type: '+str(fileinfo.meta_type()))
             logging.debug('.goutputstream file length: '+str(fileinfo.filesize()))
             logging.debug('contents: '+fileinfo.contents())
 
-        for (rule, action) in self.conf['rules']:
-            if rule.should_redact(fileinfo):
-                global first
-                if self.report_logger is not None:
-                    if first:
-                        first = False
+        if self.cache is not None:
+            fileinfo.cached_decisions = self.cache.decisions(fileinfo)
+        if self.hasher is not None:
+            self.hasher.submit(fileinfo)
+        self.metrics.count('evaluate', files=1)
+        if self.pool is not None:
+            prefetched = self.extractor is not None and self.prefetch(fileinfo)
+            self.window.append((fileinfo, self.files_walked, prefetched))
+            if len(self.window) >= POOL_WINDOW * self.jobs:
+                self.submit_window()
+        elif self.extractor is not None or self.hasher is not None:
+            # Files are evaluated a few behind the walk, so icat and hashing can run meanwhile
+            self.lookahead.append((fileinfo, self.files_walked))
+            if self.extractor is not None:
+                self.prefetch(fileinfo)
+            self.evaluate_lookahead(LOOKAHEAD)
+        else:
+            with self.metrics.phase('evaluate'):
+                matches = self.evaluate(fileinfo)
+            self.record(fileinfo, matches)
+
+    def prefetch(self, fileinfo):
+        """Starts icat on the file if a content rule may need it. Returns True if it did."""
+        if needs_icat(fileinfo) and any(self.conf['rules'][priority][0].reads_contents
+                                        for priority in self.index.candidates(fileinfo)):
+            self.extractor.prefetch(fileinfo)
+            return True
+        return False
+
+    def evaluate_lookahead(self, keep=0):
+        """Evaluates and records the files waiting in the lookahead, all but the last KEEP"""
+        while len(self.lookahead) > keep:
+            (fileinfo, walked) = self.lookahead.popleft()
+            if self.hasher is not None:
+                self.hasher.wait(fileinfo)
+            with self.metrics.phase('evaluate'):
+                matches = self.evaluate(fileinfo)
+            self.record(fileinfo, matches)
+            if self.checkpoint is not None:
+                self.checkpoint.update(files=walked)
+
+    def evaluate(self, fileinfo):
+        """Returns a list of (priority, runs) for the rules that match the file, where priority is
+        the position of the rule in the configuration and runs are the byte runs to redact. With
+        a redaction cache, decisions of content rules come from the cache when it has them, and
+        content rules that were evaluated but did not match are listed with runs of None."""
+        matches = []
+        cached = getattr(fileinfo, 'cached_decisions', None)
+        candidates = self.index.candidates(fileinfo)
+        # Each rule reads the contents once, except that rules compiled together share a scan
+        readers = set(getattr(rule, 'scanner', None) or rule
+                      for (rule, action) in (self.conf['rules'][p] for p in candidates)
+                      if rule.reads_contents and not (cached is not None and rule.line in cached))
+        contents = fileinfo.content_cache = content_cache(fileinfo, self.content_cache_size,
+                                                          self.image_reader, self.extractor,
+                                                          spool=len(readers) > 1)
+        try:
+            for priority in candidates:
+                rule, action = self.conf['rules'][priority]
+                started = timer()
+                read = contents.bytes_read
+                if cached is not None and rule.reads_contents:
+                    if rule.line in cached:
+                        runs = cached[rule.line]
+                    elif rule.should_redact(fileinfo):
+                        runs = list(rule.runs_to_redact(fileinfo))
                     else:
-                        self.report_logger.info(',')
-                action.redact(rule, fileinfo, self.output_file, self.commit)
-                self.redacted_count = self.redacted_count + 1
-                if rule.complete:
-                    return  # only need to redact once!
+                        runs = None
+                    matches.append((priority, runs))
+                elif priority in self.index.indexed or rule.should_redact(fileinfo):
+                    runs = list(rule.runs_to_redact(fileinfo))
+                    matches.append((priority, runs))
+                else:
+                    runs = None
+                self.metrics.rule(priority, timer() - started, contents.bytes_read - read, runs)
+                if runs is not None and rule.complete:
+                    break  # only need to redact once!
+        finally:
+            contents.close()
+            del fileinfo.content_cache
+        return matches
+
+    def record(self, fileinfo, matches, journal=True):
+        """Adds the matches returned by evaluate() to the report and the redaction plan, and to
+        the checkpoint journal unless they were replayed from it."""
+        global first
+        for (priority, runs) in matches:
+            rule, action = self.conf['rules'][priority]
+            if self.cache is not None and rule.reads_contents and \
+                    rule.line not in fileinfo.cached_decisions:
+                self.cache.store(fileinfo, rule, runs)
+            if runs is None:
+                continue  # no match
+            if self.report_logger is not None:
+                if first:
+                    first = False
+                else:
+                    self.report_logger.info(',')
+            action.plan(rule, fileinfo, self.plan, priority, self.commit, runs)
+            if journal and self.checkpoint is not None:
+                self.checkpoint.record(priority, fileinfo.filename(), runs)
+            self.redacted_count = self.redacted_count + 1
+
+    def start_pool(self, imagefile):
+        """Forks the worker processes that evaluate files while the walk goes on. Returns False,
+        and files are evaluated in this process, if the platform cannot fork."""
+        import multiprocessing
+        global _worker
+        try:
+            pool_factory = multiprocessing.get_context('fork').Pool
+        except AttributeError:
+            pool_factory = multiprocessing.Pool  # Python 2 always forks
+        except ValueError:
+            logging.warning('Worker processes need fork(); evaluating on a single core.')
+            return False
+        logging.debug("Evaluating files with %d workers" % self.jobs)
+        _worker = (self, imagefile.name)  # inherited by the forked workers
+        self.pool = pool_factory(self.jobs, _worker_init)
+        return True
+
+    def stop_pool(self):
+        global _worker
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        _worker = None
+
+    def submit_window(self):
+        """Hands the files of the window to the workers, largest first, then records the results
+        that are done, in walk order. Only the POOL_WINDOW * jobs files of this window are sorted,
+        not the whole walk, so the order stays bounded in memory and the walk keeps streaming. The walk waits once too many files are in flight. Files
+        icat extracts stay pinned in its cache until their results are recorded."""
+        entries = [[fileinfo, walked, None, prefetched]
+                   for (fileinfo, walked, prefetched) in self.window]
+        self.window = []
+        for entry in sorted(entries, key=lambda entry: entry[0].filesize() or 0, reverse=True):
+            if self.hasher is not None:
+                self.hasher.wait(entry[0])
+            if entry[3]:
+                self.extractor.pin(entry[0])
+            entry[2] = self.pool.apply_async(_worker_evaluate, (_portable(entry[0]),))
+        self.inflight.extend(entries)
+        self.record_inflight(POOL_INFLIGHT * self.jobs)
+
+    def record_inflight(self, keep=0):
+        """Records the results of the files in flight in walk order, waiting for them while more
+        than KEEP are in flight, so no more than KEEP results are held back for the report"""
+        while self.inflight and (len(self.inflight) > keep or self.inflight[0][2].ready()):
+            (fileinfo, walked, result, pinned) = self.inflight.popleft()
+            with self.metrics.phase('evaluate'):
+                (matches, rules) = result.get()
+            if pinned:
+                self.extractor.unpin(fileinfo)
+            self.metrics.merge_rules(rules)
+            self.record(fileinfo, matches)
+            if self.checkpoint is not None:
+                self.checkpoint.update(files=walked)
+
+    def resume_checkpoint(self):
+        """Loads the checkpoint of an earlier run and replays its journal into the plan and the
+        report. Returns the stage to resume at, or None if the run must start over."""
+        output_path = None if self.stream else self.output_file.name
+        records = self.checkpoint.load(output_path)
+        if records is None:
+            return None
+        for (priority, filename, runs) in records:
+            fileinfo = dfxml.fileobject_sax()
+            fileinfo._tags['filename'] = filename
+            runs = [dfxml.byte_run(img_offset, length, file_offset)
+                    for (img_offset, length, file_offset) in runs]
+            self.record(fileinfo, [(priority, runs)], journal=False)
+        self.resume_files = self.checkpoint.state['files']
+        logging.info("Resuming after %d files, with %d redactions from the checkpoint" %
+                     (self.resume_files, len(records)))
+        return self.checkpoint.state['stage']
 
     def close_files(self):
         for f in [self.input_file, self.output_file, self.dfxml_file]:
-            if f and f.closed is False:
+            if f and f != '-' and f.closed is False:
                 logging.debug("Closing file: %s" % f.name)
                 f.close()
         logging.debug("files closed")
@@ -148,21 +438,81 @@ class Redactor:
             self.report_logger.info(',')
             self.report_logger.info('"redactions": [')
         logging.debug('DEBUG OUTPUT IS ON')
-        # Copy input_file to output_file
-        if not self.output_file.closed:
-            self.output_file.close()
-        if not self.input_file.closed:
-            self.input_file.close()
+        for f in [self.input_file, self.output_file]:
+            if f and f != '-' and not f.closed:
+                f.close()
         import time
         t0 = time.time()  # start a timer
-        shutil.copy(self.input_file.name, self.output_file.name)
-        self.output_file = open(self.output_file.name, 'r+')
-        self.input_file = open(self.input_file.name, 'r')
-
-        fiwalk.fiwalk_using_sax(
-            imagefile=self.output_file,
-            xmlfile=self.dfxml_file,
-            callback=self.process_file)
+        self.input_file = open(self.input_file.name, 'rb')
+        stage = None
+        if self.checkpoint is not None and self.resume:
+            stage = self.resume_checkpoint()
+        if self.stream:
+            # Plan against the input, then copy and redact in one pass
+            imagefile = self.input_file
+        elif stage is not None:
+            # Carry on with the output image of the interrupted run
+            self.output_file = open(self.output_file.name, 'r+b')
+            imagefile = self.output_file
+        else:
+            # Copy input_file to output_file, then redact the copy in place
+            with self.metrics.phase('copy'):
+                method = clone_file(self.input_file.name, self.output_file.name)
+            self.metrics.count('copy', files=1, size=self.image_size)
+            logging.debug("Output image created by %s copy" % method)
+            self.output_file = open(self.output_file.name, 'r+b')
+            imagefile = self.output_file
+        if self.checkpoint is not None:
+            self.checkpoint.start(None if self.stream else self.output_file.name)
+
+        if self.cache_dir is not None:
+            self.cache = redaction_cache(self.cache_dir, self.input_file.name,
+                                         self.dfxml_file.name if self.dfxml_file else None)
+
+        if stage != 'apply':
+            self.image_reader = image_reader(imagefile)
+            if any(rule.reads_contents for (rule, action) in self.conf['rules']):
+                self.extractor = icat_extractor(
+                    imagefile.name,
+                    os.path.join(self.cache_dir, 'icat') if self.cache_dir else None)
+            if self.jobs > 1:
+                self.start_pool(imagefile)   # before the icat and hashing threads start
+            (algorithms, sizes) = self.hash_rules()
+            if algorithms:
+                self.hasher = digest_pool(
+                    imagefile.name, sorted(algorithms), sizes,
+                    digest_cache_path(self.dfxml_cache_dir, imagefile)
+                    if self.dfxml_cache_dir else None)
+            try:
+                self.walk(imagefile)
+                self.evaluate_lookahead()
+                if self.pool is not None:
+                    self.submit_window()
+                    self.record_inflight()
+            finally:
+                if self.pool is not None:
+                    self.stop_pool()
+                self.image_reader.close()
+                self.image_reader = None
+                if self.extractor is not None:
+                    self.extractor.close()
+                    self.extractor = None
+                if self.hasher is not None:
+                    self.hasher.close()
+                    self.hasher = None
+        if self.cache is not None:
+            self.cache.close()
+        if self.commit and self.stream:
+            with self.metrics.phase('write'):
+                self.stream_output()
+            self.metrics.count('write', files=1, size=self.image_size)
+        elif self.commit:
+            logging.debug("Writing %d planned extents in image order" % len(self.plan))
+            with self.metrics.phase('write'):
+                self.apply_plan()
+            self.metrics.count('write', files=1, size=self.plan.redacted_bytes())
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
         self.close_files()
 
         if self.redacted_count == 1:
@@ -175,6 +525,88 @@ class Redactor:
             self.report_logger.info('],')
             self.report_logger.info('"runtime": %d' % elapsed)
             self.report_logger.info('}')
+        self.write_metrics()
+
+    def write_metrics(self):
+        """Writes the metrics of the run to the JSON and Prometheus files that were asked for"""
+        for name in PHASES:
+            stats = self.metrics.phases[name]
+            logging.debug("%s: %.1f seconds, %d files, %d bytes" %
+                          (name, stats['seconds'], stats['files'], stats['bytes']))
+        if self.conf['metrics_file'] is not None:
+            self.metrics.write_json(self.conf['metrics_file'], self.conf['rules'])
+        if self.conf['prometheus_file'] is not None:
+            self.metrics.write_prometheus(self.conf['prometheus_file'], self.conf['rules'])
+
+    def walk(self, imagefile):
+        """Calls process_file for every fileobject of the image, from the redaction cache if it
+        holds a complete walk, or else from the DFXML file, which may be a SQLite DFXML store,
+        or from fiwalk, run once per partition in parallel if PARALLEL_WALK is set."""
+        with self.metrics.phase('dfxml'):
+            if self.cache is not None and self.cache.walked:
+                logging.debug("Reading the fileobjects from the redaction cache")
+                for fileinfo in self.cache.fileobjects(imagefile):
+                    self.process_file(fileinfo)
+            elif self.dfxml_file is not None and dfxml.is_sqlite_store(self.dfxml_file):
+                logging.debug("Reading the fileobjects from the DFXML store")
+                store = dfxml.dfxml_store(self.dfxml_file.name)
+                try:
+                    for fileinfo in store.fileobjects(imagefile):
+                        self.process_file(fileinfo)
+                finally:
+                    store.close()
+                if self.cache is not None:
+                    self.cache.finish_walk()
+            else:
+                # A cached walk must serve later configurations, so it keeps every tag
+                tags = self.needed_tags() if self.cache is None else None
+                opts = self.fiwalk_opts()
+                logging.debug("fiwalk options: -x %s" % opts)
+                if self.dfxml_file is None and self.parallel_walk and \
+                        walk_volumes(imagefile, self.process_file, fiwalk_args=opts, tags=tags,
+                                     cache_dir=self.dfxml_cache_dir):
+                    pass
+                else:
+                    fiwalk.fiwalk_using_sax(
+                        imagefile=imagefile,
+                        xmlfile=self.dfxml_file,
+                        callback=self.process_file,
+                        fiwalk_args=opts,
+                        tags=tags,
+                        cache_dir=self.dfxml_cache_dir)
+                if self.cache is not None:
+                    self.cache.finish_walk()
+                if self.dfxml_file is not None:
+                    # fiwalk's stream has no size worth charging, the image is not what it read
+                    self.metrics.count('dfxml', size=os.path.getsize(self.dfxml_file.name))
+        self.metrics.count('dfxml', files=self.files_walked)
+
+    def apply_plan(self):
+        """Writes the plan into the output image, checkpointing the image offset reached"""
+        if self.checkpoint is None:
+            self.plan.apply(self.output_file, source=self.input_file)
+            return
+        ckpt = self.checkpoint
+        if ckpt.state['stage'] != 'apply':
+            ckpt.state.update(stage='apply', files=self.files_walked, applied=0)
+            ckpt.save()
+        self.plan.apply(self.output_file, source=self.input_file, start=ckpt.state['applied'],
+                        progress=lambda offset: ckpt.update(self.output_file, applied=offset))
+        self.output_file.flush()
+
+    def stream_output(self):
+        """Streams the input image to the output file, or to standard output if the output file
+        is '-', writing the planned redactions on the way."""
+        logging.debug("Streaming image with %d planned extents" % len(self.plan))
+        self.input_file.seek(0)
+        if self.output_file == '-':
+            import sys
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            self.plan.stream(self.input_file, out)
+            out.flush()
+        else:
+            self.output_file = open(self.output_file.name, 'wb')
+            self.plan.stream(self.input_file, self.output_file)
 
     def configure_report_logger(self):
         logger = logging.getLogger('audit_report')
@@ -200,3 +632,30 @@ class Redactor:
     def setProgressCallback(self, progress_callback=None):
         """Set a callback method to report progress as offset in image bytes (int, int)."""
         self.progress_callback = progress_callback
+
+
+_worker = None          # (redactor, image path) in the pool processes
+_worker_imagefile = None
+
+
+def _worker_init():
+    """Gives each worker process its own handle on the image, so seeks do not interfere."""
+    global _worker_imagefile
+    _worker_imagefile = open(_worker[1], 'rb')
+    _worker[0].image_reader = image_reader(_worker_imagefile)
+    if _worker[0].extractor is not None:
+        _worker[0].extractor = _worker[0].extractor.reader()
+
+
+def _worker_evaluate(fileinfo):
+    redactor = _worker[0]
+    fileinfo.imagefile = _worker_imagefile
+    matches = redactor.evaluate(fileinfo)
+    return (matches, redactor.metrics.take_rules())
+
+
+def _portable(fileinfo):
+    """Returns a copy of FILEINFO to send to a worker, without the open image file"""
+    fileinfo = copy.copy(fileinfo)
+    fileinfo.imagefile = None
+    return fileinfo
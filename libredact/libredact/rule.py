@@ -1,10 +1,9 @@
+import bisect
 import re
-import mmap
-import os
+import posixpath
 import logging
 from ctypes import *
 from dfxml import byte_run
-from contextlib import closing
 try:
     from lightgrep import Lightgrep, HitAccumulator, KeyOpts
 except ImportError:
@@ -12,6 +11,12 @@ except ImportError:
                  ' in LD_LIBRARY_PATH. Without lightgrep SEQ_MATCH rules will fail.')
 
 
+lightgrep_encodings = ['US-ASCII', 'UTF-8', 'UTF-16LE', 'ISO-8859-1']
+
+CHUNK_SIZE = 1024 * 1024 * 16   # window size when a file is too large to read whole
+SEQ_MATCH_OVERLAP = 1024 * 64   # longest FILE_SEQ_MATCH match sure to be found across windows
+
+
 def convert_fileglob_to_re(fileglob):
     regex = fileglob.replace(".", "[.]").replace("*", ".*").replace("?", ".?")
     return re.compile(regex)
@@ -21,6 +26,9 @@ class redact_rule:
 
     """ Instances of this class are objects that can decide what bytes to redact."""
 
+    reads_contents = False   # True when the decision depends on the contents of the file
+    tags = ()                # DFXML fileobject tags the decision depends on, besides filename
+
     def __init__(self, line):
         self.line = line
         self.complete = True  # by default, redacts everything
@@ -33,34 +41,52 @@ class redact_rule:
     def __str__(self):
         return self.line
 
+    def iter_contents(self, fileobject, overlap=0):
+        """Yields the contents of the file as (file offset, buffer) windows, each beginning with
+        the last OVERLAP bytes of the one before. Small files come whole, in one window."""
+        cache = getattr(fileobject, 'content_cache', None)
+        if cache is None:
+            return fileobject.iter_contents(CHUNK_SIZE, overlap)
+        return cache.iter_contents(CHUNK_SIZE, overlap)
+
     def runs_to_redact(self, fi):
         """Returns the byte_runs of the source which match the rule.
         By default this is the entire object."""
         return fi.byte_runs()
 
 
+def _digest_and_size(val):
+    """Splits a hash value that may carry the file size, as in HASH:SIZE"""
+    (digest, sep, size) = val.partition(':')
+    return (digest.lower(), int(size) if sep else None)
+
+
 class rule_file_md5(redact_rule):
 
-    """Redact file if the MD5 matches"""
+    """Redact file if the MD5 matches, and the size if the value carries one (MD5:SIZE)"""
+
+    tags = ('md5',)
 
     def __init__(self, line, val):
         redact_rule.__init__(self, line)
-        self.md5val = val.lower()
+        (self.md5val, self.size) = _digest_and_size(val)
 
     def should_redact(self, fi):
-        return self.md5val == fi.tag('md5')
+        return self.md5val == fi.tag('md5') and self.size in (None, fi.filesize())
 
 
 class rule_file_sha1(redact_rule):
 
-    """Redact file if the SHA1 matches"""
+    """Redact file if the SHA1 matches, and the size if the value carries one (SHA1:SIZE)"""
+
+    tags = ('sha1',)
 
     def __init__(self, line, val):
         redact_rule.__init__(self, line)
-        self.sha1val = val.lower()
+        (self.sha1val, self.size) = _digest_and_size(val)
 
     def should_redact(self, fi):
-        return self.sha1val == fi.tag('sha1')
+        return self.sha1val == fi.tag('sha1') and self.size in (None, fi.filesize())
 
 
 class rule_file_name_match(redact_rule):
@@ -85,11 +111,8 @@ class rule_file_name_equal(redact_rule):
         self.filename = filename
 
     def should_redact(self, fileobject):
-        was = os.path.sep
-        os.path.sep = '/'                       # Force Unix filename conventions
-        ret = self.filename == os.path.basename(fileobject.filename())
-        os.path.sep = was
-        return ret
+        # Force Unix filename conventions
+        return self.filename == posixpath.basename(fileobject.filename())
 
 
 class rule_file_dirname_equal(redact_rule):
@@ -101,95 +124,74 @@ class rule_file_dirname_equal(redact_rule):
         self.dirname = dirname
 
     def should_redact(self, fileobject):
-        was = os.path.sep
-        os.path.sep = '/'                      # Force Unix filename conventions
-        ret = self.dirname == os.path.dirname(fileobject.filename())
-        os.path.sep = was
-        return ret
+        # Force Unix filename conventions
+        return self.dirname == posixpath.dirname(fileobject.filename())
 
 
 class rule_file_seq_match(redact_rule):
 
     """Redact the file if it contains a sequences matching the given pattern."""
 
+    reads_contents = True
+
     def __init__(self, line, seq_pattern):
         redact_rule.__init__(self, line)
         self.seq_pattern = seq_pattern
+        if not isinstance(seq_pattern, bytes):
+            seq_pattern = seq_pattern.encode('utf-8')   # the contents are bytes
         self.seq_pattern_re = re.compile(seq_pattern)
 
     def should_redact(self, fileobject):
-        # Use memory-mapped tempfile for more than 128MB
+        # Windows may be bytes, a bytearray or a memoryview of the image, all searched in place;
+        # files too large to hold come in overlapping windows
         if fileobject.has_contents() is False:
             return False
-        if 0 < fileobject.filesize > 1024 * 1024 * 128:
-            import tempfile
-            tf = tempfile.NamedTemporaryFile(delete=False)
-            tf.close()
-            fileobject.savefile(tf.name)
-            tf.close()
-            with closing(open(tf.name, 'r+')) as tempfile:
-                mf = mmap.mmap(tempfile.fileno(), 0, access=mmap.ACCESS_READ)
-                return self.seq_pattern_re.search(mf)
-        else:
-            byte_array = fileobject.contents()
-            return self.seq_pattern_re.search(byte_array)
+        for (offset, window) in self.iter_contents(fileobject, SEQ_MATCH_OVERLAP):
+            if self.seq_pattern_re.search(window):
+                return True
+        return False
 
 
 class rule_seq_match(redact_rule):
 
     """Redacts any sequence that matches the given pattern"""
 
+    reads_contents = True
+
     def __init__(self, line, lgpattern):
         redact_rule.__init__(self, line)
         logging.debug("Creating lightgrep-based rule for pattern: "+lgpattern)
-        self.lg = Lightgrep()
-        self.accum = HitAccumulator()
         self.lgpattern = lgpattern
         self.complete = False
-        pats = [(lgpattern, ['US-ASCII', 'UTF-8', 'UTF-16LE', 'ISO-8859-1'],
-                KeyOpts(fixedString=False, caseInsensitive=True))]
-        prog, pmap = Lightgrep.createProgram(pats)
-        self.lg.createContext(prog, pmap, self.accum.lgCallback)
+        self.keyword = (lgpattern, lightgrep_encodings,
+                        KeyOpts(fixedString=False, caseInsensitive=True))
+        self.scanner = None
 
     def should_redact(self, fileobject):
-        hitcount = self.lg.searchBuffer(fileobject.contents(), self.accum)
-        return hitcount > 0
+        return len(lightgrep_hits(self, fileobject)) > 0
 
     def runs_to_redact(self, fi):
         """Overridden to return the byte runs of just the given text"""
-        red_seqs = []
-        for h in self.accum.Hits:
-            new = True
-            for seq in red_seqs:
-                if seq[0] == h['start'] and seq[1] == h['end']:
-                    new = False
-                    break
-            if new:
-                red_seqs.append((h['start'], h['end']))
-        self.lg.reset()
-        self.accum.reset()
-        return get_runs_for_file_sequences(fi, red_seqs)
+        return get_runs_for_file_sequences(fi, merge_sequences(lightgrep_hits(self, fi)))
 
 
 class rule_file_seq_equal(redact_rule):
 
     """Redacts any file containing a sequence that equals the given string"""
 
+    reads_contents = True
+
     def __init__(self, line, text):
         redact_rule.__init__(self, line)
         logging.debug("Creating lightgrep-based rule for fixed string: "+text)
-        self.lg = Lightgrep()
-        self.accum = HitAccumulator()
         self.complete = False
         # Note reliance on fixedString keyopt below
-        pats = [(text, ['US-ASCII', 'UTF-8', 'UTF-16LE', 'ISO-8859-1'],
-                KeyOpts(fixedString=True, caseInsensitive=False))]
-        prog, pmap = Lightgrep.createProgram(pats)
-        self.lg.createContext(prog, pmap, self.accum.lgCallback)
+        self.keyword = (text, lightgrep_encodings,
+                        KeyOpts(fixedString=True, caseInsensitive=False))
+        self.scanner = None
 
     def should_redact(self, fileobject):
-        hitcount = self.lg.searchBuffer(fileobject.contents(), self.accum)
-        return hitcount > 0
+        return len(lightgrep_hits(self, fileobject)) > 0
 
     def runs_to_redact(self, fi):
         """Returns the byte_runs of the source which match the rule.
@@ -206,18 +208,79 @@ class rule_seq_equal(rule_file_seq_equal):
 
     def runs_to_redact(self, fi):
         """Overridden to return the byte runs of just the given text"""
-        red_seqs = []
-        for h in self.accum.Hits:
-            new = True
-            for seq in red_seqs:
-                if seq[0] == h['start'] and seq[1] == h['end']:
-                    new = False
-                    break
-            if new:
-                red_seqs.append((h['start'], h['end']))
-        self.lg.reset()
-        self.accum.reset()
-        return get_runs_for_file_sequences(fi, red_seqs)
+        return get_runs_for_file_sequences(fi, merge_sequences(lightgrep_hits(self, fi)))
+
+
+class lightgrep_scanner:
+
+    """Searches each file once for the patterns of several lightgrep rules, compiled into a
+    single program. The keyword index of a hit is the position of the rule that owns the
+    pattern, so each rule gets back only its own hits."""
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.lg = Lightgrep()
+        self.accum = HitAccumulator()
+        prog, pmap = Lightgrep.createProgram([rule.keyword for rule in self.rules])
+        self.lg.createContext(prog, pmap, self.accum.lgCallback)
+        self.hits = None
+        self.scanned = None
+        for i, rule in enumerate(self.rules):
+            rule.scanner = self
+            rule.keyword_index = i
+
+    def scan(self, rule, fileobject):
+        """Returns the hits for RULE in the file as (start, end) file offsets, searching the file
+        on the first call for it"""
+        # The content cache is made anew for every evaluation of a file
+        key = getattr(fileobject, 'content_cache', None) or fileobject
+        if key is not self.scanned:
+            self.hits = [[] for r in self.rules]
+            # lightgrep carries its state from window to window until done(), so they need no
+            # overlap, and counts the offset on, so hits are in file offsets
+            for (offset, window) in rule.iter_contents(fileobject):
+                if len(window) > 0:
+                    self.lg.search(window)
+            self.lg.done()
+            self.lg.reset()
+            accum = self.accum
+            if len(self.rules) == 1:
+                self.hits[0] = list(zip(accum.Starts, accum.Ends))
+            else:
+                for (i, start, end) in zip(accum.KeywordIndices, accum.Starts, accum.Ends):
+                    self.hits[i].append((start, end))
+            accum.reset()
+            self.scanned = key
+        return self.hits[rule.keyword_index]
+
+
+def lightgrep_hits(rule, fileobject):
+    """Returns the lightgrep hits for a rule in a file, compiling the rule on its own if it was
+    not compiled with others by compile_lightgrep_rules()."""
+    if rule.scanner is None:
+        lightgrep_scanner([rule])
+    return rule.scanner.scan(rule, fileobject)
+
+
+def compile_lightgrep_rules(rules):
+    """Compiles the patterns of all the lightgrep rules that are not compiled yet into one
+    program, so that each file is searched once for all of them."""
+    todo = [rule for rule in rules if getattr(rule, 'keyword', None) and rule.scanner is None]
+    if len(todo) > 0:
+        logging.debug("Compiling %d lightgrep patterns into one program" % len(todo))
+        lightgrep_scanner(todo)
+
+
+def merge_sequences(sequences):
+    """Sorts (start, end) file offsets and merges those that overlap, so repeated hits and hits
+    in several encodings give one sequence"""
+    ret = []
+    for (start, end) in sorted(sequences):
+        if ret and (start < ret[-1][1] or start == ret[-1][0]):
+            ret[-1][1] = max(ret[-1][1], end)
+        else:
+            ret.append([start, end])
+    return ret
 
 
 def get_runs_for_file_sequences(fi, file_sequences):
@@ -225,30 +288,22 @@ def get_runs_for_file_sequences(fi, file_sequences):
     '''Converts a list of file offsets into a list of image byte runs. Takes a list of tuples
     containing start, end file offsets'''
 
+    runs = sorted(fi.byte_runs(), key=lambda run: run.file_offset)
+    starts = [run.file_offset for run in runs]
     ret = []
     for start, end in file_sequences:
-        for run in fi.byte_runs():
-            # handle starting point of a sequence
-            if start > (run.file_offset + run.len):
-                continue  # not starting yet, go to next run
-            elif start < run.file_offset:  # started in prior run and not finished
-                file_offset = run.file_offset
-                img_offset = run.img_offset
-            else:  # starting within this run
-                file_offset = start
-                img_offset = run.img_offset + (start - run.file_offset)
-
-            # handle end of sequence
-            if end <= (run.file_offset + run.len):  # sequence ends within run
-                len = end - file_offset
-                ret.append(
-                    byte_run(img_offset=img_offset,
-                             len=len,
-                             file_offset=file_offset))
-            else:  # sequence ends after this run
-                len = run.len - (file_offset - run.file_offset)
-                ret.append(
-                    byte_run(img_offset=img_offset,
-                             len=len,
-                             file_offset=file_offset))
+        # the first run that may hold the start of the sequence, then the runs until its end
+        i = max(bisect.bisect_right(starts, start) - 1, 0)
+        while i < len(runs) and runs[i].file_offset < end:
+            run = runs[i]
+            i += 1
+            if run.file_offset + run.len <= start:
+                continue  # ends before the sequence starts
+            if hasattr(run, 'fill') or run.img_offset is None:
+                continue  # sparse, nothing in the image to redact
+            file_offset = max(start, run.file_offset)
+            ret.append(
+                byte_run(img_offset=run.img_offset + (file_offset - run.file_offset),
+                         len=min(end, run.file_offset + run.len) - file_offset,
+                         file_offset=file_offset))
     return ret
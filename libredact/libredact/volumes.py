@@ -0,0 +1,240 @@
+'''Parallel walks of multi-volume images
+
+fiwalk walks the volumes of an image one after another. For a raw image with a partition table,
+the partitions are read from the MBR or the GPT, each partition is cloned into a file of its own
+with a reflink of that range of the image (btrfs, XFS), so no data is copied, and one fiwalk runs
+per partition at the same time. The fileobjects are then handed on in partition order, with their
+image offsets and volumes moved back into the whole image.
+'''
+
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+from subprocess import Popen, PIPE
+import fiwalk
+from .clone import reflink_range
+
+SECTOR_SIZE = 512
+MBR_EXTENDED = (0x05, 0x0f, 0x85)
+MBR_GPT = 0xee
+MAX_LOGICAL = 128   # longest chain of extended boot records followed
+
+
+def _mbr_entries(sector):
+    """Yields (type, first sector, sectors) for the used entries of an MBR or EBR"""
+    for i in range(4):
+        entry = sector[446 + 16 * i:462 + 16 * i]
+        (ptype, first, count) = struct.unpack('<4xB3xII', entry)
+        if ptype != 0 and count != 0:
+            yield (ptype, first, count)
+
+
+def _read_sector(f, lba, sector_size=SECTOR_SIZE):
+    f.seek(lba * sector_size)
+    sector = f.read(sector_size)
+    if len(sector) < 512 or sector[510:512] != b'\x55\xaa':
+        return None
+    return sector
+
+
+def _logical_partitions(f, extended):
+    """Returns the partitions in the chain of extended boot records starting at EXTENDED"""
+    ret = []
+    lba = extended
+    for i in range(MAX_LOGICAL):
+        sector = _read_sector(f, lba)
+        if sector is None:
+            break
+        following = None
+        for (ptype, first, count) in _mbr_entries(sector):
+            if ptype not in MBR_EXTENDED:
+                ret.append((lba + first, count))
+            elif following is None:
+                following = extended + first   # the link to the next EBR, in any entry
+        if following is None or following <= lba:
+            break
+        lba = following
+    return ret
+
+
+def _gpt_partitions(f):
+    """Returns the partitions of a GPT as (offset, length) in bytes, or None if there is no GPT"""
+    for sector_size in (512, 4096):
+        f.seek(sector_size)
+        header = f.read(92)
+        if len(header) == 92 and header[:8] == b'EFI PART':
+            break
+    else:
+        return None
+    (entries, count, entry_size) = struct.unpack('<QII', header[72:88])
+    f.seek(entries * sector_size)
+    table = f.read(count * entry_size)
+    ret = []
+    for i in range(count):
+        entry = table[i * entry_size:(i + 1) * entry_size]
+        if len(entry) < 48:
+            break
+        if entry[:16] == b'\0' * 16:
+            continue   # unused entry
+        (first, last) = struct.unpack('<QQ', entry[32:48])
+        if last >= first:
+            ret.append((first * sector_size, (last - first + 1) * sector_size))
+    return ret
+
+
+def partitions(f):
+    """Returns the partitions of the raw image in file F as a list of (offset, length) in bytes,
+    sorted by offset. Extended partitions are replaced by the logical partitions in them. Returns
+    an empty list if the image has no partition table."""
+    mbr = _read_sector(f, 0)
+    if mbr is None:
+        return []
+    ret = []
+    for (ptype, first, count) in _mbr_entries(mbr):
+        if ptype == MBR_GPT:
+            return sorted(_gpt_partitions(f) or [])
+        if ptype in MBR_EXTENDED:
+            ret += [(lba * SECTOR_SIZE, n * SECTOR_SIZE)
+                    for (lba, n) in _logical_partitions(f, first)]
+        else:
+            ret.append((first * SECTOR_SIZE, count * SECTOR_SIZE))
+    return sorted(ret)
+
+
+def _clone_partition(imagefile, offset, length, path):
+    """Clones LENGTH bytes at OFFSET of IMAGEFILE into a new file at PATH. Returns False if the
+    file system cannot do it, which includes partitions that are not aligned to its blocks."""
+    src = imagefile.fileno()
+    st = os.fstat(src)
+    block = st.st_blksize or 4096
+    if offset % block or offset >= st.st_size:
+        return False
+    length = min(-(-length // block) * block, st.st_size - offset)
+    with open(path, 'wb') as dst:
+        return reflink_range(src, dst.fileno(), offset, length)
+
+
+class volume_walk:
+
+    """The fiwalk run over one partition. XML is the DFXML it writes, which is kept in the DFXML
+    cache if there is one."""
+
+    def __init__(self, number, offset, length):
+        self.number = number
+        self.offset = offset
+        self.length = length
+        self.image = None
+        self.xml = None
+        self.cached = False
+        self.process = None
+        self.volume = None
+
+    def start(self, fiwalk_cmd):
+        with open(self.xml + '.tmp', 'wb') as out:
+            self.process = Popen(fiwalk_cmd + [self.image], stdout=out)
+
+    def done(self):
+        return self.cached or (self.process is not None and self.process.poll() is not None)
+
+    def finish(self):
+        """Returns whether fiwalk found a file system in the partition"""
+        if self.cached:
+            return True
+        if self.process.wait() != 0:
+            logging.warning("fiwalk failed on partition %d at offset %d" %
+                            (self.number, self.offset))
+            os.remove(self.xml + '.tmp')
+            return False
+        os.rename(self.xml + '.tmp', self.xml)
+        return True
+
+    def fileobject(self, fi):
+        """Moves a fileobject of the partition image into the whole image"""
+        volume = getattr(fi, 'volume', None)
+        if volume is not None and volume is not self.volume:
+            volume.offset = self.offset + getattr(volume, 'offset', 0)
+            self.volume = volume
+        for run in fi.byte_runs():
+            if run.img_offset is not None:
+                run.img_offset += self.offset
+        if 'partition' in fi._tags:
+            fi._tags['partition'] = str(self.number)
+        return fi
+
+
+def walk_volumes(imagefile, callback, fiwalk_path='fiwalk', fiwalk_args='', tags=None,
+                 cache_dir=None, processes=None):
+    """Calls CALLBACK for every fileobject of IMAGEFILE, running one fiwalk per partition, at
+    most PROCESSES (default: the number of CPUs) at a time. TAGS and CACHE_DIR are as for
+    fiwalk.fiwalk_using_sax. Returns False without walking anything if the image cannot be
+    walked this way: it is not a raw image, it has fewer than two partitions, or its file
+    system cannot clone the partitions. The caller then runs a single fiwalk."""
+    if imagefile.name.endswith('.E01') or imagefile.name.endswith('.aff'):
+        return False
+    found = partitions(imagefile)
+    if len(found) < 2:
+        return False
+    if processes is None:
+        import multiprocessing
+        processes = multiprocessing.cpu_count()
+    try:
+        Popen([fiwalk_path, '-V'], stdout=PIPE).communicate()
+    except OSError:
+        raise RuntimeError("Cannot execute fiwalk executable: " + fiwalk_path)
+    try:
+        workdir = tempfile.mkdtemp(prefix='.volumes-',
+                                   dir=os.path.dirname(os.path.abspath(imagefile.name)))
+    except (IOError, OSError) as e:
+        logging.debug("Cannot walk the partitions in parallel (%s)" % e)
+        return False
+
+    walks = [volume_walk(i + 1, offset, length) for (i, (offset, length)) in enumerate(found)]
+    try:
+        for walk in walks:
+            if cache_dir is not None:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                walk.xml = fiwalk.dfxml_cache_path(cache_dir, imagefile,
+                                                   '%s\t@%d' % (fiwalk_args, walk.offset))
+                walk.cached = os.path.exists(walk.xml)
+            else:
+                walk.xml = os.path.join(workdir, 'volume%d.xml' % walk.number)
+            if walk.cached:
+                continue
+            walk.image = os.path.join(workdir, 'volume%d.raw' % walk.number)
+            if not _clone_partition(imagefile, walk.offset, walk.length, walk.image):
+                logging.debug("Cannot clone partition %d, walking the image with one fiwalk" %
+                              walk.number)
+                return False
+        logging.debug("Walking %d partitions in parallel" % len(walks))
+
+        fiwalk_cmd = [fiwalk_path, '-x']
+        if fiwalk_args:
+            fiwalk_cmd.append(fiwalk_args)
+        pending = [walk for walk in walks if not walk.cached]
+        for walk in walks:
+            while not walk.done():
+                running = len([w for w in walks if w.process and w.process.poll() is None])
+                while pending and running < processes:
+                    pending.pop(0).start(fiwalk_cmd)
+                    running += 1
+                if not pending:
+                    walk.process.wait()
+                else:
+                    time.sleep(0.05)
+            if walk.finish():
+                with open(walk.xml, 'rb') as xml:
+                    fiwalk.fiwalk_using_sax(imagefile=imagefile, xmlfile=xml, tags=tags,
+                                            callback=lambda fi: callback(walk.fileobject(fi)))
+        return True
+    finally:
+        for walk in walks:
+            if walk.process is not None and walk.process.poll() is None:
+                walk.process.kill()
+                walk.process.wait()
+                if os.path.exists(walk.xml + '.tmp'):
+                    os.remove(walk.xml + '.tmp')
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -8,7 +8,7 @@
 # otherwise an error will be generated.
 #
 
-import sys, collections
+import sys, collections, array
 from ctypes import *
 from ctypes.util import find_library
 
@@ -141,12 +141,26 @@ def _createContext(lg, prog, pmap, callback):
   ctxOpts = CtxOpts()
   lg.__ctx__ = _LG.lg_create_context(lg.__prog__, byref(ctxOpts))
   lg.CurOffset = 0
+  patInfos = {} # the pattern info of a keyword is looked up on its first hit only
   def _gotHit(user, hitPtr):
     idx = hitPtr.contents.KeywordIndex
-    hitinfo = _LG.lg_pattern_info(lg.__pmap__, idx).contents
+    hitinfo = patInfos.get(idx)
+    if hitinfo is None:
+      hitinfo = patInfos[idx] = _LG.lg_pattern_info(lg.__pmap__, idx).contents
     callback(hitPtr.contents, hitinfo)
   lg.Callback = _CBType(_gotHit)
 
+def _bufferRange(data):
+  # bytes are cast directly; other writable buffers (bytearray, mmap, memoryview) are addressed
+  # in place
+  size = len(data)
+  if isinstance(data, bytes):
+    beg = cast(data, POINTER(c_char))
+  else:
+    beg = cast((c_char * size).from_buffer(data), POINTER(c_char))
+  end = cast(addressof(beg.contents)+size, POINTER(c_char))
+  return beg, end, size
+
 # ***************** Library Init *************************#
 
 
@@ -193,24 +207,53 @@ _LG.lg_create_context.errcheck = _checkHandleForErrors
 
 
 # ***************** Lightgrep class for easy usage *************************#
+# hit offsets are 64-bit; Python 2's array has no 'Q', but its 'L' is 64-bit on LP64 systems
+_OFFSET_TYPE = 'Q' if 'Q' in getattr(array, 'typecodes', '') else 'L'
+
 class HitAccumulator:
+  # Hits are kept in parallel arrays of start and end offsets and keyword indices, and the
+  # pattern and encoding chain of a keyword are decoded on its first hit only, so that millions
+  # of hits cost little time and memory. Keywords are kept across reset(), which is for reusing
+  # the accumulator with the same program.
   def __init__(self):
+    self.Keywords = {} # pattern map index: (keyword index, pattern, encoding chain)
     self.reset()
 
   def reset(self):
-    self.KeyCounts = collections.Counter()
-    self.Hits = []
+    self.Starts = array.array(_OFFSET_TYPE)
+    self.Ends = array.array(_OFFSET_TYPE)
+    self.KeywordIndices = array.array('I')
+    self.PatternIndices = array.array('I')
 
   def lgCallback(self, hitInfo, patInfo):
-    d = {
-      "start": hitInfo.Start,
-      "end": hitInfo.End,
-      "keywordIndex": patInfo.useridx(),
-      "pattern": patInfo.pat(),
-      "encChain": patInfo.encChain()
-    }
-    self.KeyCounts[d["pattern"]] += 1
-    self.Hits.append(d)
+    idx = hitInfo.KeywordIndex
+    keyword = self.Keywords.get(idx)
+    if keyword is None:
+      keyword = self.Keywords[idx] = (patInfo.useridx(), patInfo.pat(), patInfo.encChain())
+    self.Starts.append(hitInfo.Start)
+    self.Ends.append(hitInfo.End)
+    self.KeywordIndices.append(keyword[0])
+    self.PatternIndices.append(idx)
+
+  def __len__(self):
+    return len(self.Starts)
+
+  @property
+  def KeyCounts(self):
+    counts = collections.Counter()
+    for idx, n in collections.Counter(self.PatternIndices).items():
+      counts[self.Keywords[idx][1]] += n
+    return counts
+
+  @property
+  def Hits(self):
+    # the hits as dicts, built on demand
+    hits = []
+    for start, end, idx in zip(self.Starts, self.Ends, self.PatternIndices):
+      keywordIndex, pattern, encChain = self.Keywords[idx]
+      hits.append({"start": start, "end": end, "keywordIndex": keywordIndex,
+                   "pattern": pattern, "encChain": encChain})
+    return hits
 
 class Lightgrep():
   def __init__(self, patList=None, callback=None):
@@ -233,16 +276,12 @@ class Lightgrep():
 
   def search(self, data):
     # get a pointer range of the buffer, probably what I'm least sure of
-    size = len(data)
-    beg = cast(data, POINTER(c_char))
-    end = cast(addressof(beg.contents)+size, POINTER(c_char))
+    beg, end, size = _bufferRange(data)
     _LG.lg_search(self.__ctx__, beg, end, self.CurOffset, 0, self.Callback)
     self.CurOffset += size
 
   def startswith(self, data):
-    size = len(data)
-    beg = cast(data, POINTER(c_char))
-    end = cast(addressof(beg.contents)+size, POINTER(c_char))
+    beg, end, size = _bufferRange(data)
     _LG.lg_starts_with(self.__ctx__, beg, end, 0, 0, self.Callback);
 
   def close(self):
@@ -288,13 +327,13 @@ class Lightgrep():
     self.search(data)
     self.done() # done can generate hits, too, and then will reset context
     self.reset()
-    return len(accumulator.Hits)
+    return len(accumulator)
 
   def searchBufferStartswith(self, data, accumulator):
     self.startswith(data)
     self.done() # done can generate hits, too, and then will reset context
     self.reset()
-    return len(accumulator.Hits)
+    return len(accumulator)
 
 if __name__ == "__main__":
   # using the with statement correctly releases lightgrep resources when block closes
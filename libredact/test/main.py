@@ -1,6 +1,11 @@
 import unittest
 from libredact import config, cli
 from libredact.redact import Redactor
+from libredact.plan import redaction_plan
+from libredact.action import action_fill, action_scrub, action_fuzz
+from libredact.index import rule_index
+from libredact.checkpoint import checkpoint
+import dfxml
 from io import StringIO
 import hashlib
 from contextlib import closing
@@ -118,6 +123,984 @@ IGNORE *.BACKUP
         # Verify the report only has the first config line
         self.assertEqual(file_lines(report), 1)
 
+    def test_plan_overlap(self):
+
+        """ Tests that overlapping planned extents are written once, by the higher priority. """
+
+        plan = redaction_plan()
+        plan.add(4, 8, action_fill(0x44), priority=1)
+        plan.add(2, 4, action_scrub(), priority=0)
+        plan.add(20, 2, action_fill(0x4B), priority=2)
+        self.assertEqual([(s, e) for (s, e, a) in plan.segments()], [(2, 6), (6, 12), (20, 22)])
+        self.assertEqual(plan.redacted_bytes(), 12)
+        from io import BytesIO
+        image = BytesIO(b'.' * 24)
+        plan.apply(image)
+        self.assertEqual(image.getvalue(),
+                         b'..' + b'\0' * 4 + b'D' * 6 + b'.' * 8 + b'KK' + b'..')
+        self.assertEqual(action_fill(0xf0).redacted_bytes(2), b'\xf0\xf0')
+        self.assertEqual(action_fuzz().redacted_bytes(3, b'a\x80\xff'), b'a\xa0\xbf')
+
+    def test_plan_stream(self):
+
+        """ Tests that streaming a copy gives the same bytes as redacting a copy in place. """
+
+        plan = redaction_plan()
+        plan.add(3, 10, action_fill(0x44), priority=1)
+        plan.add(8, 9, action_scrub(), priority=0)
+        from io import BytesIO
+        source = b'abcdefghijklmnopqrstuvwxyz'
+        image = BytesIO(source)
+        plan.apply(image)
+        streamed = BytesIO()
+        plan.stream(BytesIO(source), streamed, chunk_size=4)
+        self.assertEqual(streamed.getvalue(), image.getvalue())
+
+    def test_clone_file(self):
+
+        """ Tests that cloning a sparse image copies its data and keeps its holes. """
+
+        import os
+        import stat
+        import tempfile
+        from libredact.clone import clone_file
+        tmp = tempfile.mkdtemp()
+        src = os.path.join(tmp, 'sparse.raw')
+        dst = os.path.join(tmp, 'clone.raw')
+        size = 16 * 1024 * 1024
+        with open(src, 'wb') as f:
+            f.write(b'A' * 4096)
+            f.seek(8 * 1024 * 1024)
+            f.write(b'B' * 4096)
+            f.truncate(size)   # ends with a hole
+        os.chmod(src, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP)
+        method = clone_file(src, dst)
+        self.assertTrue(method in ('reflink', 'copy_file_range', 'sparse'))
+        self.assertEqual(md5sum(dst), md5sum(src))
+        self.assertEqual(os.path.getsize(dst), size)
+        self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode), stat.S_IMODE(os.stat(src).st_mode))
+        if os.stat(src).st_blocks * 512 < size // 2:   # the file system keeps holes
+            self.assertTrue(os.stat(dst).st_blocks * 512 < size // 2)
+
+    def test_rule_index(self):
+
+        """ Tests that indexed lookups pick the same config lines as testing each rule. """
+
+        rules = config.parsehandle(StringIO(u"""
+FILE_MD5 114583cd8355334071e9343a929f6f7c FILL 0x44
+FILE_NAME_EQUAL DRINKME.TXT SCRUB
+FILE_DIRNAME_EQUAL looking-glass SCRUB
+FILE_NAME_MATCH *Whale.txt FUZZ
+"""))['rules']
+        index = rule_index(rules)
+        fi = dfxml.fileobject_sax()
+        fi._tags = {'filename': 'looking-glass/DRINKME.TXT',
+                    'md5': '114583cd8355334071e9343a929f6f7c'}
+        self.assertEqual(index.candidates(fi), [0, 1, 2, 3])
+        self.assertEqual([p for p in index.candidates(fi)
+                          if p in index.indexed or rules[p][0].should_redact(fi)],
+                         [p for p, (rule, action) in enumerate(rules) if rule.should_redact(fi)])
+        fi._tags = {'filename': 'Moby Dick/The Whale.txt'}
+        self.assertEqual(index.candidates(fi), [3])
+
+    def test_checkpoint_resume(self):
+
+        """ Tests that a saved checkpoint gives back its journal, but only for the same output. """
+
+        import os
+        import tempfile
+        tmp = tempfile.mkdtemp()
+        output = os.path.join(tmp, 'out.raw')
+        with open(output, 'wb') as f:
+            f.write(b'\0' * 1024)
+        ckpt = checkpoint(output + '.checkpoint', 'abc')
+        ckpt.start(output)
+        ckpt.record(2, 'DRINKME.TXT', [dfxml.byte_run(512, 100, 0)])
+        ckpt.update(files=7)
+        ckpt.save()
+        ckpt.record(3, 'lost.txt', [dfxml.byte_run(0, 10, 0)])  # after the last save
+        resumed = checkpoint(output + '.checkpoint', 'abc')
+        self.assertEqual(resumed.load(output), [[2, 'DRINKME.TXT', [[512, 100, 0]]]])
+        self.assertEqual(resumed.state['files'], 7)
+        self.assertEqual(checkpoint(output + '.checkpoint', 'other').load(output), None)
+        with open(output + '.new', 'wb') as f:
+            f.write(b'\0' * 1024)
+        os.rename(output + '.new', output)  # another file in its place
+        self.assertEqual(checkpoint(output + '.checkpoint', 'abc').load(output), None)
+        ckpt.remove()
+
+    def test_dfxml_store(self):
+
+        """ Tests that fileobjects read back from a SQLite DFXML store match the DFXML. """
+
+        import os
+        import tempfile
+        from io import BytesIO
+        xml = b"""<?xml version='1.0' encoding='UTF-8'?>
+<dfxml version='1.0'><volume offset='1048576'><block_size>4096</block_size>
+<fileobject><filename>docs/DRINKME.TXT</filename><filesize>300</filesize><alloc>1</alloc>
+<byte_runs><byte_run file_offset='0' img_offset='2048' len='100'/>
+<byte_run file_offset='100' img_offset='8192' len='200'/></byte_runs>
+<hashdigest type='md5'>114583cd8355334071e9343a929f6f7c</hashdigest></fileobject>
+<fileobject><filename>small.txt</filename><filesize>5</filesize><alloc>0</alloc>
+<byte_runs><byte_run file_offset='0' fill='0' len='5'/></byte_runs></fileobject>
+</volume></dfxml>"""
+        path = os.path.join(tempfile.mkdtemp(), 'store.db')
+        store = dfxml.dfxml_to_sqlite(BytesIO(xml), path)
+        self.assertTrue(dfxml.is_sqlite_store(path))
+        expected = dfxml.fileobjects_sax(xmlfile=BytesIO(xml))
+        iterated = dfxml.fileobjects_iter(xmlfile=BytesIO(xml), chunk_size=64)
+        self.assertEqual([fi._tags for fi in iterated], [fi._tags for fi in expected])
+        found = list(store.fileobjects())
+        self.assertEqual([fi._tags for fi in found], [fi._tags for fi in expected])
+        self.assertEqual([[str(run) for run in fi.byte_runs()] for fi in found],
+                         [[str(run) for run in fi.byte_runs()] for fi in expected])
+        self.assertEqual(found[1].byte_runs()[0].fill, 0)
+        self.assertEqual(found[0].volume.offset, 1048576)
+        self.assertEqual([fi.filename() for fi in store.at_offset(8300)], ['docs/DRINKME.TXT'])
+        self.assertEqual([fi.filename() for fi in store.by_md5(
+            '114583cd8355334071e9343a929f6f7c')], ['docs/DRINKME.TXT'])
+        self.assertEqual(store.longest_run(), 200)
+        store.close()
+        # the volumes of a walk are freed as it goes, and must not be confused with one another
+        xml = b"<?xml version='1.0' encoding='UTF-8'?>\n<dfxml version='1.0'>" + b"".join(
+            b"<volume offset='%d'><block_size>512</block_size><fileobject><filename>%s"
+            b"</filename><filesize>1</filesize></fileobject></volume>" % (offset, name)
+            for (offset, name) in [(1000, b'a'), (5000, b'b'), (9000, b'c')]) + b"</dfxml>"
+        store = dfxml.dfxml_to_sqlite(BytesIO(xml), path)
+        self.assertEqual([(fi.filename(), fi.volume.offset) for fi in store.fileobjects()],
+                         [('a', 1000), ('b', 5000), ('c', 9000)])
+        store.close()
+
+    def test_dfxml_reader(self):
+
+        """ Tests that fileobject_reader reads the volumes, tags, hashes and runs of fileobjects. """
+
+        from io import BytesIO
+        xml = b"""<?xml version='1.0' encoding='UTF-8'?>
+<dfxml version='1.0'><source><image_filename>disk.raw</image_filename></source>
+<volume offset='32256'><block_size>4096</block_size>
+<fileobject><filename>docs/a.txt</filename><filesize>300</filesize><alloc>1</alloc>
+<byte_runs><byte_run file_offset='0' img_offset='2048' len='100'>
+<hashdigest type='MD5'>0cc175b9c0f1b6a831c399e269772661</hashdigest></byte_run>
+<byte_run file_offset='100' img_offset='8192' len='200'/></byte_runs>
+<hashdigest type='md5'>114583cd8355334071e9343a929f6f7c</hashdigest>
+<hashdigest type='sha1'>7f9f0286e16e9c74c992e682e27487a9eb691e86</hashdigest></fileobject>
+</volume><volume offset='1048576'><block_size>512</block_size>
+<fileobject><filename>b &amp; c.txt</filename><filesize>5</filesize><alloc>0</alloc>
+<byte_runs><byte_run file_offset='0' fill='0' len='5'/></byte_runs></fileobject>
+</volume></dfxml>"""
+
+        def parse(tags):
+            reader = dfxml.fileobject_reader(tags=tags)
+            found = []
+            reader.process_xml_stream(BytesIO(xml), found.append)
+            return (reader.imageobject._tags,
+                    [(fi._tags, fi.hashdigest, fi.volume.offset, fi.volume.block_size,
+                      [(run.img_offset, run.file_offset, run.len, getattr(run, 'fill', None),
+                        run.hashdigest) for run in fi.byte_runs()]) for fi in found])
+
+        (image, found) = parse(None)
+        self.assertEqual(image['image_filename'], 'disk.raw')
+        self.assertEqual([fi[0]['filename'] for fi in found], ['docs/a.txt', 'b & c.txt'])
+        self.assertEqual(found[0][0]['alloc'], '1')
+        self.assertEqual(found[0][1:4], ({'md5': '114583cd8355334071e9343a929f6f7c',
+                                          'sha1': '7f9f0286e16e9c74c992e682e27487a9eb691e86'},
+                                         32256, 4096))
+        self.assertEqual(found[1][2:4], (1048576, 512))
+        self.assertEqual(found[0][4], [(2048, 0, 100, None,
+                                        {'md5': '0cc175b9c0f1b6a831c399e269772661'}),
+                                       (8192, 100, 200, None, {})])
+        self.assertEqual(found[1][4], [(None, 0, 5, 0, {})])
+        (image, found) = parse(('filename', 'filesize', 'md5'))
+        self.assertEqual([sorted(fi[0]) for fi in found], [['filename', 'filesize', 'md5'],
+                                                           ['filename', 'filesize']])
+        self.assertEqual(found[0][1], {'md5': '114583cd8355334071e9343a929f6f7c'})
+
+    def test_needed_tags(self):
+
+        """ Tests that the DFXML reader keeps only the tags the rules need. """
+
+        import os
+        from io import BytesIO
+        from libredact.redact import BASE_TAGS, CONTENT_TAGS
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        cfg = config.parsehandle(StringIO(u"FILE_MD5 114583cd8355334071e9343a929f6f7c FILL 0x44\n"
+                                          u"FILE_NAME_MATCH *.txt SCRUB\n"))
+        cfg['input_file'] = os.path.join(dirname, "test_image.raw")
+        tags = Redactor(**cfg).needed_tags()
+        self.assertEqual(tags, set(BASE_TAGS + CONTENT_TAGS + ('md5',)))
+        xml = b"""<?xml version='1.0' encoding='UTF-8'?>
+<dfxml version='1.0'><volume offset='0'><block_size>512</block_size>
+<fileobject><filename>a.txt</filename><filesize>100</filesize><inode>12</inode>
+<mtime>2011-01-01T00:00:00Z</mtime><uid>0</uid>
+<byte_runs><byte_run file_offset='0' img_offset='2048' len='100'>
+<hashdigest type='md5'>0cc175b9c0f1b6a831c399e269772661</hashdigest></byte_run></byte_runs>
+<hashdigest type='md5'>114583cd8355334071e9343a929f6f7c</hashdigest>
+<hashdigest type='sha1'>7f9f0286e16e9c74c992e682e27487a9eb691e86</hashdigest></fileobject>
+</volume></dfxml>"""
+        for kept in [tags, tags | set(['hashdigest'])]:
+            found = []
+            dfxml.fileobject_reader(tags=kept).process_xml_stream(BytesIO(xml), found.append)
+            fi = found[0]
+            self.assertEqual(sorted(fi._tags), ['filename', 'filesize', 'inode', 'md5'])
+            self.assertEqual(fi.hashdigest, {'md5': '114583cd8355334071e9343a929f6f7c'})
+            self.assertEqual(fi.tag('sha1'), None)
+            run = fi.byte_runs()[0]
+            self.assertEqual((run.img_offset, run.len, run.file_offset), (2048, 100, 0))
+            self.assertEqual(run.hashdigest, {'md5': '0cc175b9c0f1b6a831c399e269772661'}
+                             if 'hashdigest' in kept else {})
+
+    def test_redaction_cache(self):
+
+        """ Tests that a second run reuses the walk and the decisions of unchanged rules. """
+
+        import os
+        import tempfile
+        from libredact import rule
+        from libredact.cache import redaction_cache
+        tmp = tempfile.mkdtemp()
+        image = os.path.join(tmp, 'in.raw')
+        data = bytearray(b'.' * 4096)
+        data[0:11] = b'hello world'
+        data[1000:1011] = b'hello there'
+        data[2000:2008] = b'Kafka xx'
+        with open(image, 'wb') as f:
+            f.write(bytes(data))
+        xml = os.path.join(tmp, 'in.xml')
+        with open(xml, 'w') as f:
+            f.write("<?xml version='1.0' encoding='UTF-8'?>\n<dfxml version='1.0'>"
+                    "<volume offset='0'><block_size>512</block_size>" + "".join(
+                        "<fileobject><filename>f%d.txt</filename><filesize>100</filesize>"
+                        "<byte_runs><byte_run file_offset='0' img_offset='%d' len='100'/>"
+                        "</byte_runs></fileobject>" % (i, i * 1000) for i in range(3)) +
+                    "</volume></dfxml>")
+        evaluated = []
+        should_redact = rule.rule_file_seq_match.should_redact
+
+        def spy(self, fileobject):
+            evaluated.append(self.line)
+            return should_redact(self, fileobject)
+
+        def run(rules):
+            del evaluated[:]
+            redactor = Redactor(input_file=image, output_file=os.path.join(tmp, 'out.raw'),
+                                dfxml_file=xml, ignore_patterns=[],
+                                rules=config.parsehandle(StringIO(rules))['rules'],
+                                cache_dir=os.path.join(tmp, 'cache'))
+            redactor.execute()
+            return redactor.redacted_count
+
+        world = u"FILE_SEQ_MATCH world FILL 0x44\n"
+        there = u"FILE_SEQ_MATCH there SCRUB\n"
+        rule.rule_file_seq_match.should_redact = spy
+        try:
+            self.assertEqual(run(world), 1)
+            self.assertEqual(len(evaluated), 3)
+            self.assertEqual(run(world + there), 2)
+            self.assertEqual(evaluated, [there.strip()] * 2)   # f0.txt is filled already
+            self.assertEqual(run(u"FILE_SEQ_MATCH hello FILL 0x44\n" + there), 2)
+            self.assertEqual(evaluated, [u"FILE_SEQ_MATCH hello FILL 0x44"] * 3)
+        finally:
+            rule.rule_file_seq_match.should_redact = should_redact
+        cache = redaction_cache(os.path.join(tmp, 'cache'), image, xml)
+        self.assertTrue(cache.walked)
+        found = list(cache.fileobjects(None))
+        self.assertEqual([fi.filename() for fi in found], ['f0.txt', 'f1.txt', 'f2.txt'])
+        self.assertEqual([str(fi.byte_runs()[0]) for fi in found],
+                         [str(dfxml.byte_run(i * 1000, 100, 0)) for i in range(3)])
+        self.assertEqual(found[0].volume.block_size, 512)
+        cache.close()
+
+    def test_byte_run(self):
+
+        """ Tests that byte runs keep their offsets in slots and rare attributes aside. """
+
+        import copy
+        import pickle
+        run = dfxml.byte_run()
+        self.assertEqual((run.img_offset, run.file_offset, run.len, run._extra),
+                         (None, None, None, None))
+        self.assertEqual(run.sector_size, 512)
+        self.assertFalse(hasattr(run, 'fill'))
+        run.decode_sax_attributes({'file_offset': '0', 'img_offset': '2048', 'bytes': '100',
+                                   'fill': '0', 'type': 'resident'})
+        self.assertEqual((run.img_offset, run.file_offset, run.len), (2048, 0, 100))
+        self.assertEqual(run._extra, {'fill': 0, 'type': 'resident'})
+        run.hashdigest['md5'] = '0cc175b9c0f1b6a831c399e269772661'
+        run.sector_size = 4096
+        self.assertEqual(run.start_sector(), 0)
+        for other in [pickle.loads(pickle.dumps(run, 0)), pickle.loads(pickle.dumps(run, 2)),
+                      copy.copy(run), copy.deepcopy(run)]:
+            self.assertEqual((other.img_offset, other.file_offset, other.len),
+                             (2048, 0, 100))
+            self.assertEqual(other._extra, run._extra)
+            self.assertFalse(other._extra is run._extra)
+        del run.fill
+        self.assertFalse(hasattr(run, 'fill'))
+        self.assertRaises(AttributeError, delattr, run, 'fill')
+        old = dfxml.byte_run.__new__(dfxml.byte_run)   # pickled before byte_run had slots
+        old.__setstate__({'img_offset': 512, 'len': 10, 'file_offset': 0, 'fill': 0x41})
+        self.assertEqual((old.img_offset, old.len, old.file_offset, old.fill),
+                         (512, 10, 0, 0x41))
+
+    def test_iter_contents(self):
+
+        """ Tests that overlapping content windows cover a fragmented file exactly. """
+
+        from io import BytesIO
+        source = bytes(bytearray(range(256))) * 4
+        image = BytesIO(source)
+        image.name = 'image.raw'
+        fill = dfxml.byte_run(None, 10, 50)
+        fill.fill = 0x41
+        fi = dfxml.fileobject_sax(imagefile=image)
+        fi._byte_runs = [dfxml.byte_run(100, 50, 0), fill, dfxml.byte_run(500, 60, 60)]
+        expected = source[100:150] + b'A' * 10 + source[500:560]
+        windows = list(fi.iter_contents(chunk_size=16, overlap=4))
+        for (offset, window) in windows:
+            self.assertEqual(window, expected[offset:offset + len(window)])
+            self.assertTrue(len(window) <= 20)
+        self.assertEqual([offset for (offset, window) in windows], [0, 12, 28, 44, 60, 76, 92, 108])
+        self.assertEqual(windows[-1][0] + len(windows[-1][1]), len(expected))
+
+    def test_shared_contents(self):
+
+        """ Tests that a file too large to hold is read from the image once for all rules. """
+
+        import os
+        import tempfile
+        tmp = tempfile.mkdtemp()
+        data = bytearray(b'.' * 8192)
+        data[5000:5006] = b'needle'
+        (image, xml) = write_image(tmp, data, [('big.txt', [(0, 2000), (4000, 3000)])])
+        rules = config.parsehandle(StringIO(u"FILE_SEQ_MATCH haystack SCRUB\n"
+                                            u"FILE_SEQ_MATCH needle FILL 0x44\n"))['rules']
+        redactor = Redactor(input_file=image, output_file=os.path.join(tmp, 'out.raw'),
+                            dfxml_file=xml, ignore_patterns=[], rules=rules, commit=True,
+                            content_cache_size=1024)
+        redactor.execute()
+        stats = redactor.metrics.rules
+        self.assertEqual([stats[0]['bytes_read'], stats[1]['bytes_read']], [5000, 0])
+        self.assertEqual([stats[0]['matches'], stats[1]['matches']], [0, 1])
+        with open(os.path.join(tmp, 'out.raw'), 'rb') as f:
+            self.assertEqual(f.read(), b'D' * 2000 + b'.' * 2000 + b'D' * 3000 + b'.' * 1192)
+
+    def test_metrics(self):
+
+        """ Tests the JSON and Prometheus metrics of a redaction. """
+
+        import os
+        import json
+        import tempfile
+        tmp = tempfile.mkdtemp()
+        data = bytearray(b'.' * 2048)
+        data[100:106] = b'secret'
+        (image, xml) = write_image(tmp, data, [('a.txt', [(0, 512)]), ('b.txt', [(512, 512)]),
+                                               ('c.txt', [(1024, 300)])])
+        rules = config.parsehandle(StringIO(u"FILE_SEQ_MATCH secret FILL 0x44\n"
+                                            u"FILE_NAME_MATCH c.txt FILL 0x43\n"))['rules']
+        metrics = os.path.join(tmp, 'metrics.json')
+        prometheus = os.path.join(tmp, 'metrics.prom')
+        Redactor(input_file=image, output_file=os.path.join(tmp, 'out.raw'), dfxml_file=xml,
+                 ignore_patterns=[], rules=rules, commit=True, metrics_file=metrics,
+                 prometheus_file=prometheus).execute()
+        with open(metrics) as f:
+            stats = json.load(f)
+        self.assertEqual([(rule['priority'], rule['files'], rule['matches'], rule['bytes_redacted'])
+                          for rule in stats['rules']], [(0, 3, 1, 512), (1, 2, 1, 300)])
+        self.assertEqual(stats['rules'][0]['bytes_read'], 1324)
+        self.assertEqual(stats['phases']['dfxml']['files'], 3)
+        self.assertEqual(stats['phases']['dfxml']['bytes'], os.path.getsize(xml))
+        with open(prometheus) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# HELP libredact_rule_matches Files the rule matched', lines)
+        self.assertIn('# TYPE libredact_rule_matches gauge', lines)
+        self.assertIn('libredact_rule_matches{priority="1",rule="%s"} 1.0' % rules[1][0], lines)
+        self.assertIn('libredact_rule_bytes_redacted{priority="0",rule="%s"} 512.0' % rules[0][0],
+                      lines)
+        self.assertIn('libredact_phase_files{phase="dfxml"} 3.0', lines)
+
+    def test_worker_pool(self):
+
+        """ Tests that worker processes give the same plan, report and output as one process. """
+
+        import os
+        import tempfile
+        from libredact import redact
+        tmp = tempfile.mkdtemp()
+        data = bytearray(b'.' * 40 * 512)
+        files = []
+        for i in range(40):
+            size = 50 * (i % 7 + 1)   # files of many sizes, so the workers take them out of order
+            if i % 3 == 0:
+                data[i * 512 + size - 6:i * 512 + size] = b'secret'
+            files.append(('f%d.txt' % i, [(i * 512, size)]))
+        (image, xml) = write_image(tmp, data, files)
+        rules = u"FILE_SEQ_MATCH secret SCRUB\nFILE_NAME_MATCH *7.txt FILL 0x44\n"
+
+        def run(jobs):
+            output = os.path.join(tmp, 'out%d.raw' % jobs)
+            report = os.path.join(tmp, 'report%d.json' % jobs)
+            redactor = Redactor(input_file=image, output_file=output, report_file=report,
+                                dfxml_file=xml, ignore_patterns=[], commit=True, jobs=jobs,
+                                rules=config.parsehandle(StringIO(rules))['rules'])
+            redactor.execute()
+            with open(output, 'rb') as f:
+                written = f.read()
+            with open(report) as f:
+                logged = f.read()   # the configuration and runtime differ, the redactions must not
+            logged = logged[logged.index('"redactions"'):logged.index('"runtime"')]
+            return ([(start, end, action.__class__.__name__)
+                     for (start, end, action) in redactor.plan.segments()], logged, written)
+
+        inflight = redact.POOL_INFLIGHT
+        redact.POOL_INFLIGHT = 1   # the walk waits for results as well
+        try:
+            pooled = run(3)
+        finally:
+            redact.POOL_INFLIGHT = inflight
+        single = run(1)
+        self.assertEqual(len(single[0]), 17)
+        self.assertEqual(pooled, single)
+
+    def test_hit_accumulator(self):
+
+        """ Tests that the hit accumulator keeps the hits, and decodes each pattern once. """
+
+        from lightgrep import HitAccumulator
+
+        class hit:
+            def __init__(self, start, end, index):
+                (self.Start, self.End, self.KeywordIndex) = (start, end, index)
+
+        class pattern:
+            decoded = 0
+
+            def __init__(self, text, encoding, index):
+                (self.text, self.encoding, self.index) = (text, encoding, index)
+
+            def pat(self):
+                pattern.decoded += 1
+                return self.text
+
+            def encChain(self):
+                return self.encoding
+
+            def useridx(self):
+                return self.index
+
+        # pattern map entries 0 and 1 are one keyword in two encodings
+        patterns = [pattern('alpha', 'ASCII', 0), pattern('alpha', 'UTF-16LE', 0),
+                    pattern('omega', 'ASCII', 1)]
+        accum = HitAccumulator()
+        for (start, end, index) in [(10, 15, 0), (20, 30, 1), (40, 45, 2), (50, 55, 0)]:
+            accum.lgCallback(hit(start, end, index), patterns[index])
+        self.assertEqual(len(accum), 4)
+        self.assertEqual(pattern.decoded, 3)
+        self.assertEqual(accum.Hits[1], {'start': 20, 'end': 30, 'keywordIndex': 0,
+                                         'pattern': 'alpha', 'encChain': 'UTF-16LE'})
+        self.assertEqual([(h['start'], h['keywordIndex']) for h in accum.Hits],
+                         [(10, 0), (20, 0), (40, 1), (50, 0)])
+        self.assertEqual(dict(accum.KeyCounts), {'alpha': 3, 'omega': 1})
+        accum.reset()
+        self.assertEqual((len(accum), accum.Hits, dict(accum.KeyCounts)), (0, [], {}))
+        accum.lgCallback(hit(60, 65, 2), patterns[2])
+        self.assertEqual(pattern.decoded, 3)
+        self.assertEqual(accum.Hits, [{'start': 60, 'end': 65, 'keywordIndex': 1,
+                                       'pattern': 'omega', 'encChain': 'ASCII'}])
+
+    def test_lightgrep_scanner(self):
+
+        """ Tests that the hits of one lightgrep program go back to the rule of their keyword. """
+
+        import os
+        import tempfile
+        from libredact import rule
+
+        class hit:
+            def __init__(self, start, end, index):
+                (self.Start, self.End, self.KeywordIndex) = (start, end, index)
+
+        class pattern:
+            def __init__(self, text, index):
+                (self.text, self.index) = (text, index)
+
+            def pat(self):
+                return self.text
+
+            def encChain(self):
+                return 'ASCII'
+
+            def useridx(self):
+                return self.index
+
+        class stub_lightgrep:
+            # Two pattern map entries per keyword, as with two encodings, so that the pattern
+            # index of a hit is not the keyword index the user gave
+            @staticmethod
+            def createProgram(patList):
+                return (None, [(text, i) for (i, (text, encodings, opts)) in enumerate(patList)])
+
+            def createContext(self, prog, pmap, callback):
+                (self.pmap, self.callback, self.data) = (pmap, callback, b'')
+
+            def search(self, data):
+                self.data += bytes(data)
+
+            def done(self):
+                for (text, i) in self.pmap:
+                    start = self.data.find(text.encode('ascii'))
+                    while start >= 0:
+                        self.callback(hit(start, start + len(text), 2 * i + 1), pattern(text, i))
+                        start = self.data.find(text.encode('ascii'), start + 1)
+
+            def reset(self):
+                self.data = b''
+
+        tmp = tempfile.mkdtemp()
+        data = bytearray(b'.' * 1024)
+        data[10:15] = b'alpha'
+        data[100:105] = b'omega'
+        data[600:605] = b'alpha'
+        (image, xml) = write_image(tmp, data, [('a.txt', [(0, 512)]), ('b.txt', [(512, 512)])])
+        rules = config.parsehandle(StringIO(u"SEQ_EQUAL alpha FILL 0x41\n"
+                                            u"SEQ_EQUAL omega FILL 0x4F\n"))['rules']
+        lightgrep = rule.Lightgrep
+        rule.Lightgrep = stub_lightgrep
+        try:
+            redactor = Redactor(input_file=image, output_file=os.path.join(tmp, 'out.raw'),
+                                dfxml_file=xml, ignore_patterns=[], rules=rules, commit=True)
+            redactor.execute()
+        finally:
+            rule.Lightgrep = lightgrep
+        self.assertIs(rules[0][0].scanner, rules[1][0].scanner)
+        self.assertEqual([(start, end, action.fillvalue)
+                          for (start, end, action) in redactor.plan.segments()],
+                         [(10, 15, 0x41), (100, 105, 0x4F), (600, 605, 0x41)])
+        with open(os.path.join(tmp, 'out.raw'), 'rb') as f:
+            self.assertEqual(f.read()[:700], b'.' * 10 + b'A' * 5 + b'.' * 85 + b'O' * 5 +
+                             b'.' * 495 + b'A' * 5 + b'.' * 95)
+
+    def test_image_reader(self):
+
+        """ Tests that an image_reader reads the same contents mapped and with readinto. """
+
+        import mmap
+        import tempfile
+        from libredact import content
+        source = bytes(bytearray(range(256))) * 16
+        image = tempfile.NamedTemporaryFile(suffix='.raw')
+        image.write(source)
+        image.flush()
+
+        def fileobject(*runs):
+            fi = dfxml.fileobject_sax(imagefile=image)
+            for (img_offset, length, fill) in runs:
+                run = dfxml.byte_run(img_offset, length, 0)
+                if fill is not None:
+                    run.fill = fill
+                fi._byte_runs.append(run)
+            return fi
+
+        files = [(fileobject((100, 50, None), (150, 200, None)), source[100:350]),
+                 (fileobject((100, 50, None), (3000, 60, None)),
+                  source[100:150] + source[3000:3060]),
+                 (fileobject((100, 50, None), (None, 10, 0x41), (None, 5, 0), (500, 60, None)),
+                  source[100:150] + b'A' * 10 + b'\0' * 5 + source[500:560])]
+
+        class unmappable:
+            @staticmethod
+            def mmap(*args, **kwargs):
+                raise EnvironmentError("cannot map")
+        unmappable.ACCESS_COPY = mmap.ACCESS_COPY
+
+        mapped = content.image_reader(image)
+        content.mmap = unmappable
+        try:
+            unmapped = content.image_reader(image)
+        finally:
+            content.mmap = mmap
+        self.assertEqual(mapped.view is not None, content.ZERO_COPY)
+        self.assertEqual(unmapped.view, None)
+        for reader in [mapped, unmapped]:
+            for (i, (fi, expected)) in enumerate(files):
+                maps = reader.maps(fi)
+                self.assertEqual(maps, i == 0 and reader is mapped and content.ZERO_COPY)
+                contents = reader.contents(fi)
+                self.assertTrue(isinstance(contents, memoryview if maps else bytearray))
+                self.assertEqual(bytes(contents), expected)
+                pieces = [(offset, bytes(piece)) for (offset, piece) in reader.iter_runs(fi, 32)]
+                self.assertEqual(b''.join(piece for (offset, piece) in pieces), expected)
+                self.assertEqual([offset for (offset, piece) in pieces],
+                                 [sum(len(piece) for (o, piece) in pieces[:j])
+                                  for j in range(len(pieces))])
+                self.assertTrue(all(len(piece) <= 32 for (offset, piece) in pieces))
+            reader.close()
+        image.close()
+
+    def test_streamed_sequences(self):
+
+        """ Tests that a SEQ rule finds a sequence that straddles two reads of an unmapped image. """
+
+        import os
+        import mmap
+        import tempfile
+        from libredact import content, rule
+
+        class unmappable:
+            @staticmethod
+            def mmap(*args, **kwargs):
+                raise EnvironmentError("cannot map")
+        unmappable.ACCESS_COPY = mmap.ACCESS_COPY
+
+        tmp = tempfile.mkdtemp()
+        data = bytearray(b'.' * 1024)
+        data[97:100] = b'nee'     # across the two runs
+        data[512:515] = b'dle'
+        data[572:578] = b'needle'  # across two 64 byte reads of the second run
+        (image, xml) = write_image(tmp, data, [('big.txt', [(0, 100), (512, 300)])])
+        rules = config.parsehandle(StringIO(u"SEQ_EQUAL needle FILL 0x4E\n"))['rules']
+        chunk_size = rule.CHUNK_SIZE
+        (content.mmap, rule.CHUNK_SIZE) = (unmappable, 64)
+        try:
+            redactor = Redactor(input_file=image, output_file=os.path.join(tmp, 'out.raw'),
+                                dfxml_file=xml, ignore_patterns=[], rules=rules, commit=True,
+                                content_cache_size=64)
+            redactor.execute()
+        finally:
+            (content.mmap, rule.CHUNK_SIZE) = (mmap, chunk_size)
+        self.assertEqual(redactor.metrics.rules[0]['bytes_read'], 400)
+        self.assertEqual(redactor.metrics.rules[0]['matches'], 1)
+        expected = bytearray(data)
+        expected[97:100] = expected[512:515] = b'NNN'
+        expected[572:578] = b'NNNNNN'
+        with open(os.path.join(tmp, 'out.raw'), 'rb') as f:
+            self.assertEqual(f.read(), bytes(expected))
+
+    def test_file_sequences(self):
+
+        """ Tests that streamed runs and merged hits in file offsets map back to the image. """
+
+        import tempfile
+        from libredact.content import image_reader
+        from libredact.rule import get_runs_for_file_sequences, merge_sequences
+        source = bytes(bytearray(range(256))) * 4
+        image = tempfile.TemporaryFile()
+        image.write(source)
+        image.flush()
+        fill = dfxml.byte_run(None, 10, 50)
+        fill.fill = 0x41
+        fi = dfxml.fileobject_sax(imagefile=image)
+        fi._byte_runs = [dfxml.byte_run(100, 50, 0), fill, dfxml.byte_run(500, 60, 60)]
+        reader = image_reader(image)
+        pieces = [(offset, bytes(piece)) for (offset, piece) in reader.iter_runs(fi, 32)]
+        reader.close()
+        self.assertEqual([(offset, len(piece)) for (offset, piece) in pieces],
+                         [(0, 32), (32, 18), (50, 10), (60, 32), (92, 28)])
+        self.assertEqual(b''.join(piece for (offset, piece) in pieces),
+                         source[100:150] + b'A' * 10 + source[500:560])
+        hits = [(100, 110), (40, 70), (45, 60), (100, 110)]
+        runs = get_runs_for_file_sequences(fi, merge_sequences(hits))
+        self.assertEqual([(r.img_offset, r.len, r.file_offset) for r in runs],
+                         [(140, 10, 40), (500, 10, 60), (540, 10, 100)])
+
+    def test_icat_extractor(self):
+
+        """ Tests pooled icat extraction and its cache against a stub icat. """
+
+        import os
+        import stat
+        import tempfile
+        from libredact.extract import icat_extractor
+        tmp = tempfile.mkdtemp()
+        icat = os.path.join(tmp, 'icat')
+        with open(icat, 'w') as f:
+            f.write('#!/bin/sh\necho "$*" >> %s/calls\nfor inode; do :; done\n' % tmp +
+                    '[ $inode = 13 ] && { echo "no such inode" >&2; exit 1; }\n'
+                    'printf "contents of inode %s" $inode\n')
+        os.chmod(icat, stat.S_IRWXU)
+        image = open(os.path.join(tmp, 'disk.E01'), 'wb')
+        files = []
+        for inode in ['11', '12', '13']:
+            fi = dfxml.fileobject_sax(imagefile=image)
+            fi._tags = {'filename': 'file' + inode, 'inode': inode}
+            fi.volume = dfxml.volumeobject_sax()
+            fi.volume.offset = 32256
+            files.append(fi)
+        extractor = icat_extractor(image.name, os.path.join(tmp, 'cache'), icat=icat)
+        for fi in files:
+            extractor.prefetch(fi)
+        with extractor.extract(files[1]) as f:
+            self.assertEqual(f.read(), b'contents of inode 12')
+        self.assertRaises(ValueError, extractor.extract, files[2])
+        extractor.close()
+        again = icat_extractor(image.name, os.path.join(tmp, 'cache'), icat=icat)
+        with again.extract(files[0]) as f:
+            self.assertEqual(f.read(), b'contents of inode 11')
+        again.close()
+        with open(os.path.join(tmp, 'calls')) as f:
+            calls = f.read().split('\n')
+        self.assertEqual(len([c for c in calls if c.endswith(' 11')]), 1)
+        self.assertTrue('-b 512 -o 63 %s 11' % image.name in calls)
+
+        # Files pinned for the readers of worker processes outlast eviction until unpinned
+        small = icat_extractor(image.name, os.path.join(tmp, 'small'), max_cache=30, icat=icat)
+        self.assertEqual(small.threads, [])
+        reader = small.reader()
+        small.pin(files[0])
+        with small.extract(files[1]) as f:
+            self.assertEqual(f.read(), b'contents of inode 12')
+        with reader.extract(files[0]) as f:
+            self.assertEqual(f.read(), b'contents of inode 11')
+        self.assertRaises(ValueError, small.pin, files[2])
+        small.unpin(files[0])
+        self.assertRaises(ValueError, reader.extract, files[0])
+        self.assertEqual(small.size, 20)
+        small.close()
+
+    def test_digest_pool(self):
+
+        """ Tests that missing digests are computed from the byte runs and kept for later runs. """
+
+        import os
+        import tempfile
+        from libredact.digest import digest_pool
+        tmp = tempfile.mkdtemp()
+        image = open(os.path.join(tmp, 'disk.raw'), 'wb')
+        image.write(b'hello' + b'.' * 507 + b' world')
+        image.close()
+        fi = dfxml.fileobject_sax()
+        fi._tags = {'filename': 'hello.txt', 'filesize': '14'}
+        fi._byte_runs = [dfxml.byte_run(0, 5, 0), dfxml.byte_run(None, 3, 5),
+                         dfxml.byte_run(512, 6, 8)]
+        fi._byte_runs[1].fill = 0x20
+        other = dfxml.fileobject_sax()
+        other._tags = {'filename': 'other.txt', 'filesize': '512'}
+        other._byte_runs = [dfxml.byte_run(0, 512, 0)]
+        cache_path = os.path.join(tmp, 'digests')
+        pool = digest_pool(image.name, ['md5', 'sha1'], sizes=set([14]), cache_path=cache_path)
+        for f in [fi, other]:
+            pool.submit(f)
+            pool.wait(f)
+        pool.close()
+        self.assertEqual(fi.tag('md5'), hashlib.md5(b'hello    world').hexdigest())
+        self.assertEqual(other.tag('md5'), None)
+        del fi._tags['md5'], fi._tags['sha1']
+        again = digest_pool(os.path.join(tmp, 'missing.raw'), ['sha1'], cache_path=cache_path)
+        again.submit(fi)
+        again.close()
+        self.assertEqual(fi.tag('sha1'), hashlib.sha1(b'hello    world').hexdigest())
+
+    def test_extentdb(self):
+
+        """ Tests extent lookups and set operations on the sorted extent database. """
+
+        db = dfxml.extentdb()
+        db.add_runs([dfxml.byte_run(1024, 512), dfxml.byte_run(0, 512)])
+        db.add(dfxml.byte_run(4096, 1024))
+        self.assertRaises(ValueError, db.add, dfxml.byte_run(1500, 100))
+        self.assertEqual(db.intersects(dfxml.byte_run(512, 512)), None)
+        self.assertEqual(db.intersects(dfxml.byte_run(500, 600)).img_offset, 0)
+        self.assertEqual([r.img_offset for r in db.runs_in(256, 4097)], [0, 1024, 4096])
+        self.assertEqual(db.sectors_not_in_db(dfxml.byte_run(0, 6144)), [1, 3, 4, 5, 6, 7, 10, 11])
+        other = [dfxml.byte_run(256, 1024), dfxml.byte_run(4608, 4096)]
+        self.assertEqual([(r.img_offset, r.len) for r in db.union(other)],
+                         [(0, 1536), (4096, 4608)])
+        self.assertEqual([(r.img_offset, r.len) for r in db.difference(other)],
+                         [(0, 256), (1280, 256), (4096, 512)])
+
+    def test_partitions(self):
+
+        """ Tests that partitions are read from an MBR with a logical partition. """
+
+        import struct
+        from io import BytesIO
+        from libredact.volumes import partitions
+
+        def boot_record(entries):
+            sector = bytearray(512)
+            for i, entry in enumerate(entries):
+                sector[446 + 16 * i:462 + 16 * i] = struct.pack('<4xB3xII', *entry)
+            sector[510:512] = b'\x55\xaa'
+            return bytes(sector)
+
+        image = BytesIO()
+        image.write(boot_record([(0x83, 2048, 2048), (0x05, 6144, 4096), (0x07, 4096, 2048)]))
+        image.seek(6144 * 512)
+        image.write(boot_record([(0x83, 2048, 2048)]))
+        self.assertEqual(partitions(image), [(1048576, 1048576), (2097152, 1048576),
+                                             (4194304, 1048576)])
+        # the link to the next extended boot record may come before the logical partition
+        image.seek(6144 * 512)
+        image.write(boot_record([(0x05, 4096, 2048), (0x83, 2048, 1024)]))
+        image.seek(10240 * 512)
+        image.write(boot_record([(0x83, 2048, 1024)]))
+        self.assertEqual(partitions(image), [(1048576, 1048576), (2097152, 1048576),
+                                             (4194304, 524288), (6291456, 524288)])
+        self.assertEqual(partitions(BytesIO(b'\0' * 1024)), [])
+
+    def test_walk_volumes(self):
+
+        """ Tests that partitions walked by a stub fiwalk are merged back into the image. """
+
+        import os
+        import stat
+        import struct
+        import tempfile
+        from libredact import volumes
+        tmp = tempfile.mkdtemp()
+        stub = os.path.join(tmp, 'fiwalk')
+        with open(stub, 'w') as f:
+            f.write('#!/bin/sh\n[ "$1" = -V ] && exit 0\nfor image; do :; done\n'
+                    'echo "$*" >> %s/calls\nname=$(head -c 5 "$image")\n' % tmp +
+                    '[ $name = part1 ] && sleep 0.2\n'   # the first partition finishes last
+                    'printf "<?xml version=\'1.0\'?><dfxml><volume offset=\'0\'><fileobject>'
+                    '<filename>%s</filename><partition>1</partition><byte_runs><byte_run '
+                    'file_offset=\'0\' img_offset=\'512\' len=\'5\'/></byte_runs></fileobject>'
+                    '</volume></dfxml>" $name\n')
+        os.chmod(stub, stat.S_IRWXU)
+        sector = bytearray(512)
+        for (i, lba) in enumerate([256, 128, 384]):   # aligned to file system blocks
+            sector[446 + 16 * i:462 + 16 * i] = struct.pack('<4xB3xII', 0x83, lba, 8)
+        sector[510:512] = b'\x55\xaa'
+        image = open(os.path.join(tmp, 'disk.raw'), 'w+b')
+        image.write(bytes(sector) + b'\0' * (392 * 512 - 512))
+        for (number, lba) in [(1, 128), (2, 256), (3, 384)]:
+            image.seek(lba * 512)
+            image.write(b'part%d' % number)
+        image.flush()
+
+        def copy_range(src, dst, offset, length):
+            os.lseek(src, offset, os.SEEK_SET)
+            os.write(dst, os.read(src, length))
+            return True
+
+        def walk(cache_dir=None):
+            found = []
+            walked = volumes.walk_volumes(
+                image, lambda fi: found.append((fi.filename(), fi.volume.offset,
+                                                fi.byte_runs()[0].img_offset, fi.tag('partition'))),
+                fiwalk_path=stub, cache_dir=cache_dir, processes=3)
+            return (walked, found)
+
+        def walks():
+            with open(os.path.join(tmp, 'calls')) as f:
+                return len(f.readlines())
+
+        expected = [('part%d' % n, offset, offset + 512, str(n))
+                    for (n, offset) in [(1, 65536), (2, 131072), (3, 196608)]]
+        reflink_range = volumes.reflink_range
+        volumes.reflink_range = copy_range   # /tmp may not clone files
+        try:
+            self.assertEqual(walk(), (True, expected))
+            self.assertEqual(walk(os.path.join(tmp, 'cache')), (True, expected))
+            self.assertEqual(walks(), 6)
+            self.assertEqual(walk(os.path.join(tmp, 'cache')), (True, expected))
+            self.assertEqual(walks(), 6)   # every partition came from the cache
+            volumes.reflink_range = lambda src, dst, offset, length: False
+            self.assertEqual(walk(), (False, []))
+            self.assertEqual(walks(), 6)
+        finally:
+            volumes.reflink_range = reflink_range
+        self.assertEqual([name for name in os.listdir(tmp) if name.startswith('.volumes-')], [])
+
+    def test_fiwalk_opts(self):
+
+        """ Tests that fiwalk computes only the hashes that the rules compare. """
+
+        import os
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        cfg = config.parsehandle(StringIO(u"FILE_NAME_MATCH *Whale.txt FUZZ\n"))
+        cfg['input_file'] = os.path.join(dirname, "test_image.raw")
+        self.assertEqual(Redactor(**cfg).fiwalk_opts(), "-z")
+        cfg['allocated_only'] = True
+        self.assertEqual(Redactor(**cfg).fiwalk_opts(), "-zO")
+        cfg = config.parsehandle(StringIO(config_string))
+        cfg['input_file'] = os.path.join(dirname, "test_image.raw")
+        cfg['dfxml_file'] = None
+        self.assertEqual(Redactor(**cfg).fiwalk_opts(), "")
+        cfg['rules'] = [r for r in cfg['rules'] if r[0].__class__.__name__ != 'rule_file_sha1']
+        self.assertEqual(Redactor(**cfg).fiwalk_opts(), "-zM")
+        cfg['rules'] = config.parsehandle(StringIO(
+            u"FILE_MD5 114583cd8355334071e9343a929f6f7c:1024 FILL 0x44\n"))['rules']
+        self.assertEqual(Redactor(**cfg).fiwalk_opts(), "-z")
+
+
+    def test_fiwalk_cache(self):
+
+        """ Tests that fiwalk output is cached once parsed, and never from a failed walk. """
+
+        import os
+        import stat
+        import tempfile
+        import fiwalk
+        from xml.parsers.expat import ExpatError
+        tmp = tempfile.mkdtemp()
+        stub = os.path.join(tmp, 'fiwalk')
+        with open(stub, 'w') as f:
+            f.write('#!/bin/sh\n[ "$1" = -V ] && { echo "FIWalk Version: 4.0"; exit 0; }\n'
+                    'echo "$*" >> %s/calls\n' % tmp +
+                    'printf "<?xml version=\'1.0\'?><dfxml><volume offset=\'0\'><fileobject>'
+                    '<filename>a.txt</filename></fileobject>"\n'
+                    '[ -e %s/truncate ] && exit 0\n' % tmp +
+                    'printf "</volume></dfxml>"\n'
+                    '[ -e %s/fail ] && exit 1\n' % tmp + 'exit 0\n')
+        os.chmod(stub, stat.S_IRWXU)
+        image = open(os.path.join(tmp, 'disk.raw'), 'wb')
+        image.write(b'\0' * 4096)
+        image.close()
+        cache = os.path.join(tmp, 'cache')
+        cached = []
+
+        def walk(args):
+            found = []
+
+            def callback(fi):
+                cached.append(os.path.exists(fiwalk.dfxml_cache_path(cache, image, args)))
+                found.append(fi.filename())
+            fiwalk.fiwalk_using_sax(imagefile=image, fiwalk=stub, callback=callback,
+                                    fiwalk_args=args, cache_dir=cache)
+            return found
+
+        def walks():
+            with open(os.path.join(tmp, 'calls')) as f:
+                return len(f.readlines())
+
+        self.assertEqual(walk('-z'), ['a.txt'])        # a miss runs fiwalk
+        self.assertEqual(walk('-z'), ['a.txt'])        # and a hit reads its output
+        self.assertEqual(cached, [False, True])
+        self.assertEqual(walks(), 1)
+        open(os.path.join(tmp, 'fail'), 'w').close()
+        self.assertEqual(walk('-zM'), ['a.txt'])       # the XML is whole, but fiwalk failed
+        open(os.path.join(tmp, 'truncate'), 'w').close()
+        self.assertRaises(ExpatError, walk, '-z1')     # fiwalk exited cleanly, but the XML is cut
+        self.assertEqual(walks(), 3)
+        self.assertEqual(os.listdir(cache), [os.path.basename(
+            fiwalk.dfxml_cache_path(cache, image, '-z'))])
+
+def write_image(directory, data, files):
+    """Writes DATA as in.raw in DIRECTORY, and in.xml, a DFXML file for FILES, a list of
+    (filename, [(img_offset, len), ...]). Returns the two paths."""
+    import os
+    image = os.path.join(directory, 'in.raw')
+    with open(image, 'wb') as f:
+        f.write(bytes(data))
+    xml = os.path.join(directory, 'in.xml')
+    with open(xml, 'w') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n<dfxml version='1.0'>"
+                "<volume offset='0'><block_size>512</block_size>")
+        for (name, runs) in files:
+            f.write("<fileobject><filename>%s</filename><filesize>%d</filesize><byte_runs>" %
+                    (name, sum(length for (offset, length) in runs)))
+            file_offset = 0
+            for (offset, length) in runs:
+                f.write("<byte_run file_offset='%d' img_offset='%d' len='%d'/>" %
+                        (file_offset, offset, length))
+                file_offset += length
+            f.write("</byte_runs></fileobject>")
+        f.write("</volume></dfxml>")
+    return (image, xml)
 
 def md5sum(filename):
     md5 = hashlib.md5()